@@ -1,15 +1,28 @@
 """
 Perform configured actions when various things happen.
 Actions themselves are presumably defined in the config file.
+
+The actions are not run right away. Instead they are put in a queue
+in the database (see QueuedAction), and a fixed number of worker
+threads take them from there. That way a slow action (e.g. sending
+email to an unresponsive server) doesn't hold up the request, and no
+actions are lost if the app is restarted. Failed actions are retried
+a few times, with increasing delays.
 """
 
+from collections import Counter, defaultdict, deque
+from datetime import datetime
 from functools import partial
+import json
 import logging
-from threading import Thread
+from threading import Thread, Condition
+from time import monotonic
 
-from flask import current_app
+from flask import current_app, Response
 from blinker import Namespace
 
+from .db import QueuedAction
+
 
 signals = Namespace()
 
@@ -19,24 +32,187 @@ new_entry = signals.signal("new_entry")
 edit_entry = signals.signal("edit_entry")
 new_logbook = signals.signal("new_logbook")
 edit_logbook = signals.signal("edit_logbook")
+new_attachment = signals.signal("new_attachment")
+delete_attachment = signals.signal("delete_attachment")
+new_lock = signals.signal("new_lock")
+cancel_lock = signals.signal("cancel_lock")
+# sent when the database may have been changed some other way, e.g.
+# by another process, so that any cached data can be thrown away.
+data_changed = signals.signal("data_changed")
 
 
-def on_signal(signal_name, *args, **kwargs):
-    "Find and run any action configured for the signal."
-    action_config = current_app.config.get("ACTIONS", {})
-    action = action_config.get(signal_name)
-    if action:
-        logging.debug("Running configured action for '%s'", signal_name)
+# How often idle workers look in the queue anyway, e.g. for actions
+# that are due to be retried, or were queued by another process.
+POLL_INTERVAL = 5
+
+# How many of the latest actions to base the timing statistics on
+N_TIMINGS = 100
+
+
+class ActionStats:
+
+    "Keeps track of how actions have been doing, in this process"
+
+    def __init__(self):
+        self.succeeded = Counter()
+        self.errors = Counter()
+        # (latency, duration) of the latest actions. The latency is
+        # the time from when the action was queued until it finished.
+        self.timings = defaultdict(partial(deque, maxlen=N_TIMINGS))
+
+    def add_success(self, signal, latency, duration):
+        self.succeeded[signal] += 1
+        self.timings[signal].append((latency, duration))
+
+    def add_error(self, signal):
+        self.errors[signal] += 1
+
+    def get(self, signal):
+        timings = self.timings[signal]
+        if timings:
+            latencies, durations = zip(*timings)
+        else:
+            latencies = durations = [0]
+        return dict(succeeded=self.succeeded[signal],
+                    errors=self.errors[signal],
+                    latency=sum(latencies) / len(latencies),
+                    max_latency=max(latencies),
+                    duration=sum(durations) / len(durations),
+                    max_duration=max(durations))
+
+
+class ActionWorkers:
+
+    """
+    A fixed size pool of threads that run queued actions. Each kind
+    of action (i.e. signal) may be limited in how many can run at
+    the same time, see ACTION_CONCURRENCY in the config. Note that
+    the limits apply per process.
+    """
+
+    def __init__(self):
+        self._condition = Condition()
+        self._notified = 0
+        self._threads = []
+        self._running = Counter()  # signal -> number of running actions
+        self.stats = ActionStats()
+
+    def start(self, app):
+        "Start the workers, unless they are already running"
+        with self._condition:
+            if self._threads:
+                return
+            for i in range(app.config.get("ACTION_WORKERS", 4)):
+                thread = Thread(target=self._work, args=(app,),
+                                name="action-worker-{}".format(i),
+                                daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    @property
+    def size(self):
+        return len(self._threads)
+
+    def notify(self):
+        "Tell a worker that there is something new in the queue"
+        with self._condition:
+            self._notified += 1
+            self._condition.notify()
+
+    def _wait(self, timeout):
+        with self._condition:
+            if not self._notified:
+                self._condition.wait(timeout)
+            self._notified = max(self._notified - 1, 0)
+
+    def _work(self, app):
+        with app.app_context():
+            while True:
+                try:
+                    if self.run_next(app.config):
+                        continue
+                except Exception as e:
+                    # probably trouble with the database; try later
+                    logging.error("Action worker failed: %s", e)
+                self._wait(POLL_INTERVAL)
+
+    def run_next(self, config):
+        """Run the next action that is due, if any. Returns False if
+        there was nothing to do."""
+        limits = config.get("ACTION_CONCURRENCY", {})
+        with self._condition:
+            busy = [signal for signal, n in self._running.items()
+                    if signal in limits and n >= limits[signal]]
+        # Claiming may have to wait for the database, so don't hold
+        # the lock meanwhile; that would block notify(). Two workers
+        # claiming at the same time may briefly exceed a limit.
+        action = QueuedAction.claim(
+            busy, timeout=config.get("ACTION_TIMEOUT", 300))
+        if action is None:
+            return False
+        with self._condition:
+            self._running[action.signal] += 1
+        try:
+            self._run(action, config)
+        finally:
+            with self._condition:
+                self._running[action.signal] -= 1
+            if action.signal in limits:
+                # other actions may have been waiting for this one
+                self.notify()
+        return True
+
+    def _run(self, action, config):
+        function = config.get("ACTIONS", {}).get(action.signal)
+        if function is None:
+            # must have been removed from the config since
+            action.give_up("No action configured")
+            return
+        logging.debug("Running configured action for '%s'", action.signal)
+        start = monotonic()
         try:
-            # The action is run in a thread, to prevent it from hanging
-            # the whole app, e.g. if it does some slow network stuff.
-            # This is a bit naive, a flood of actions might create a
-            # ridiculous number of threads. Maybe better to use a worker
-            # pool and a queue or something?
-            Thread(target=action, args=args, kwargs=kwargs).run()
+            function(*action.data["args"], **action.data["kwargs"])
         except Exception as e:
             logging.error("Caught exception in action for '%s': %s",
-                          signal_name, e)
+                          action.signal, e)
+            self.stats.add_error(action.signal)
+            if action.attempts >= config.get("ACTION_MAX_ATTEMPTS", 5):
+                action.give_up(repr(e))
+            else:
+                delay = (config.get("ACTION_RETRY_DELAY", 10) *
+                         2 ** (action.attempts - 1))
+                action.retry(repr(e), delay)
+        else:
+            duration = monotonic() - start
+            latency = (datetime.utcnow() - action.created_at).total_seconds()
+            action.delete_instance()
+            self.stats.add_success(action.signal, latency, duration)
+
+
+workers = ActionWorkers()
+
+
+def queue_action(signal_name, *args, **kwargs):
+    """Queue any action configured for the signal. This should be done
+    in the same transaction as the change that the signal is about
+    (see api.send_signal), so that either both or none are saved."""
+    action_config = current_app.config.get("ACTIONS", {})
+    if action_config.get(signal_name):
+        logging.debug("Queueing configured action for '%s'", signal_name)
+        # views may return responses, but we can only store data
+        args = [json.loads(arg.get_data(as_text=True))
+                if isinstance(arg, Response) else arg
+                for arg in args]
+        QueuedAction.create(signal=signal_name,
+                            data=dict(args=args, kwargs=kwargs))
+
+
+def on_signal(signal_name, *args, **kwargs):
+    "Wake up the workers, if there is an action for the signal."
+    action_config = current_app.config.get("ACTIONS", {})
+    if action_config.get(signal_name):
+        workers.start(current_app._get_current_object())
+        workers.notify()
 
 
 for name, signal in signals.items():
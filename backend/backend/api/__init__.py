@@ -1,14 +1,21 @@
 from functools import wraps
 
+from ..actions import queue_action
+from ..db import db
+
 
 def send_signal(signal):
     """Decorator that ensures that the given signal is sent
     with the result of the decorated view function, if it's
-    successful."""
+    successful. Any action configured for the signal is queued
+    in the same transaction as the view makes its changes in,
+    so that the action can't get lost."""
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            result = f(*args, **kwargs)
+            with db.atomic():
+                result = f(*args, **kwargs)
+                queue_action(signal.name, result)
             signal.send(result)
             return result
         return decorated_function
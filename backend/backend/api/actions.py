@@ -0,0 +1,23 @@
+from flask_restful import Resource
+
+from ..db import QueuedAction
+from ..actions import workers
+from . import fields
+from .serialize import marshal_with
+
+
+class ActionsResource(Resource):
+
+    @marshal_with(fields.actions)
+    def get(self):
+        """How the configured actions are doing; the number of queued
+        actions, and how long they take. Note that the timings only
+        cover the actions run by this process."""
+        queue = QueuedAction.get_queue_stats()
+        signals = sorted(set(queue) | set(workers.stats.succeeded) |
+                         set(workers.stats.errors))
+        return dict(workers=workers.size,
+                    actions=[dict(signal=signal,
+                                  **queue.get(signal, {}),
+                                  **workers.stats.get(signal))
+                             for signal in signals])
@@ -7,7 +7,9 @@ from werkzeug import FileStorage
 from ..db import Attachment
 
 from ..attachments import save_attachment
+from ..actions import new_attachment, delete_attachment
 from ..utils import get_utc_datetime
+from . import send_signal
 
 
 attachments_parser = reqparse.RequestParser()
@@ -22,6 +24,7 @@ attachments_parser.add_argument("embedded", type=bool,
 
 class AttachmentsResource(Resource):
 
+    @send_signal(new_attachment)
     def post(self, logbook_id, entry_id):
         "Upload attachments to an entry"
         args = attachments_parser.parse_args()
@@ -46,6 +49,7 @@ class AttachmentsResource(Resource):
                        filename=attachment.filename,
                        metadata=attachment.metadata)
 
+    @send_signal(delete_attachment)
     def delete(self, logbook_id, entry_id, attachment_id):
         "Delete attachments to an entry"
         attachment = Attachment.get(Attachment.id == attachment_id)
@@ -0,0 +1,95 @@
+"""
+A cache for API responses.
+
+Many clients keep asking for the same logbooks and entries, which
+rarely change. The marshalled responses are kept here, keyed on the
+endpoint and the arguments, and thrown away as soon as any signal is
+sent (see actions.py), since pretty much any change may affect some
+of them. The responses get ETags, so that clients that already have
+the latest version can be told so without even looking in the db.
+"""
+
+from collections import OrderedDict
+from functools import wraps
+from hashlib import sha1
+import json
+from threading import Lock
+
+from flask import current_app, request, Response
+
+from ..actions import signals
+
+
+class ResponseCache:
+
+    def __init__(self):
+        self._responses = OrderedDict()
+        self._lock = Lock()
+        # increased on every change, so that a response that was
+        # made from data that changed meanwhile isn't stored.
+        self.generation = 0
+
+    def get(self, key):
+        with self._lock:
+            response = self._responses.get(key)
+            if response is not None:
+                self._responses.move_to_end(key)
+            return response
+
+    def put(self, key, response, generation, max_size):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._responses[key] = response
+            while len(self._responses) > max_size:
+                self._responses.popitem(last=False)
+
+    def clear(self, *args, **kwargs):
+        with self._lock:
+            self.generation += 1
+            self._responses.clear()
+
+
+response_cache = ResponseCache()
+
+for signal in signals.values():
+    signal.connect(response_cache.clear, weak=False)
+
+
+def make_etag(data):
+    return sha1(json.dumps(data).encode("utf-8")).hexdigest()
+
+
+def cached_response(cacheable=None):
+    """Decorator for GET methods that return marshalled data. The
+    result is cached, unless the cacheable function says otherwise.
+    Other results (e.g. files) are passed through as they are."""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.is_json:
+                # arguments in a JSON body; unusual for GET, skip it
+                return f(*args, **kwargs)
+            # Note: arguments may also come as form data
+            key = (request.endpoint,
+                   tuple(sorted(request.view_args.items())),
+                   tuple(sorted(request.values.items(multi=True))))
+            cached = response_cache.get(key)
+            if cached is None:
+                generation = response_cache.generation
+                data = f(*args, **kwargs)
+                if isinstance(data, (Response, tuple)):
+                    return data
+                etag = make_etag(data)
+                if cacheable is None or cacheable(data):
+                    response_cache.put(
+                        key, (etag, data), generation,
+                        current_app.config.get("RESPONSE_CACHE_SIZE", 1000))
+            else:
+                etag, data = cached
+            headers = {"ETag": '"{}"'.format(etag)}
+            if etag in request.if_none_match:
+                return Response(status=304, headers=headers)
+            return data, 200, headers
+        return decorated_function
+    return decorator
@@ -0,0 +1,47 @@
+from time import monotonic
+
+from flask import current_app
+from flask_restful import Resource
+from webargs.fields import Integer, Float
+from webargs.flaskparser import use_args
+
+from ..db import Logbook, ChangeSequence
+from . import fields
+from .serialize import marshal_with
+
+
+changes_args = {
+    "since": Integer(missing=0),
+    "limit": Integer(missing=1000, validate=lambda n: 0 < n <= 10000),
+    "wait": Float(missing=0, validate=lambda t: t >= 0)
+}
+
+
+class ChangesResource(Resource):
+
+    @use_args(changes_args)
+    @marshal_with(fields.changed, envelope="changed")
+    def get(self, args, logbook_id=None):
+        """Logbooks and entries changed after the "since" cursor,
+        optionally in a logbook (and its descendants). Only the ids,
+        revision numbers and so on are returned; it's up to the
+        client to fetch what it needs. Ask again with the returned
+        cursor to get the next changes. Given "wait", the request
+        blocks for up to that many seconds, until there is something
+        to return."""
+        if logbook_id is not None:
+            # check that it exists
+            Logbook.get(Logbook.id == logbook_id)
+        wait = min(args["wait"], current_app.config.get("CHANGES_MAX_WAIT", 60))
+        deadline = monotonic() + wait
+        cursor = args["since"]
+        while True:
+            logbooks, entries, cursor = ChangeSequence.get_changed(
+                cursor, logbook=logbook_id, limit=args["limit"])
+            remaining = deadline - monotonic()
+            if logbooks or entries or remaining <= 0:
+                break
+            # Nothing here yet. Note that the cursor may still move,
+            # if things change elsewhere.
+            ChangeSequence.wait(cursor, remaining)
+        return dict(logbooks=logbooks, entries=entries, cursor=cursor)
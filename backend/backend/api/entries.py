@@ -1,16 +1,23 @@
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+import binascii
+import json
 import logging
 
-from flask import request, send_file
-from flask_restful import Resource, marshal, marshal_with, abort
+from flask import (current_app, request, send_file, Response,
+                   stream_with_context)
+from flask_restful import Resource, abort
 from webargs.fields import (Integer, Str, Boolean, Dict, List,
                             Nested, Email, LocalDateTime)
 from webargs.flaskparser import use_args
 
-from ..db import Entry, Logbook, EntryLock
+from ..db import db, Entry, Logbook, EntryLock, time_limit, SearchTimeout
+from ..db import fulltext_query
 from ..attachments import handle_img_tags
 from ..export import export_entries_as_pdf
-from ..actions import new_entry, edit_entry
+from ..actions import new_entry, edit_entry, new_lock, cancel_lock
 from . import fields, send_signal
+from .cache import cached_response
+from .serialize import marshal, marshal_with
 
 
 entry_args = {
@@ -36,19 +43,26 @@ entry_args = {
 }
 
 
+def has_lock(entry):
+    "Check a marshalled entry and its followups for locks"
+    return (entry["lock"] is not None or
+            any(has_lock(followup) for followup in entry["followups"]))
+
+
 class EntryResource(Resource):
 
     "Handle requests for a single entry"
 
+    @cached_response(cacheable=lambda data: not has_lock(data["entry"]))
     @use_args({"thread": Boolean(missing=False)})
     @marshal_with(fields.entry_full, envelope="entry")
     def get(self, args, entry_id, logbook_id=None, revision_n=None):
-        entry = Entry.get(Entry.id == entry_id)
         if revision_n is not None:
+            entry = Entry.get(Entry.id == entry_id)
             return entry.get_revision(revision_n)
-        if args["thread"]:
-            return entry._thread
-        return entry
+        # load all the followups at once, instead of one at a time
+        # while marshalling
+        return Entry.get_thread(entry_id, whole=args["thread"])
 
     @send_signal(new_entry)
     @use_args(entry_args)
@@ -71,6 +85,7 @@ class EntryResource(Resource):
         else:
             inline_attachments = []
         args["logbook"] = logbook
+        args.pop("revision_n", None)
         # make sure the attributes are of proper types
         try:
             args["attributes"] = logbook.check_attributes(args.get("attributes", {}))
@@ -96,9 +111,11 @@ class EntryResource(Resource):
         # client to supply the "revision_n" field of the entry they
         # are editing. If this does not match the current entry in the
         # db, it means someone has changed it inbetween and we abort.
+        # Note that the entry may still be changed by someone else
+        # before we save it; that is caught by Entry.save.
         if "revision_n" not in args:
             abort(400, message="Missing 'revision_n' field!")
-        if args["revision_n"] != entry.revision_n:
+        if args.pop("revision_n") != entry.revision_n:
             abort(409, message=(
                 "Conflict: Entry {} has been edited since you last loaded it!"
                 .format(entry_id)))
@@ -121,10 +138,10 @@ class EntryResource(Resource):
         else:
             inline_attachments = []
 
-        entry = Entry.get(Entry.id == entry_id)
         change = entry.make_change(**args)
-        entry.save()
-        change.save()
+        with db.atomic():
+            entry.save()
+            change.save()
         for attachment in inline_attachments:
             attachment.entry = entry
             attachment.save()
@@ -144,13 +161,101 @@ entries_args = {
     "offset": Integer(),
     "download": Str(),
     "sort_by_timestamp": Boolean(missing=True),
+    "ranked": Boolean(missing=False),
+    "cursor": Str(),
+    "stream": Str(validate=lambda s: s in ["json", "ndjson"]),
 }
 
 
+def encode_cursor(position):
+    "Make an opaque string out of a position in the search results"
+    data = json.dumps(position).encode("utf-8")
+    return urlsafe_b64encode(data).decode("ascii")
+
+
+def decode_cursor(cursor):
+    try:
+        priority, sort_key, entry_id = json.loads(
+            urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+    except (ValueError, TypeError, binascii.Error):
+        abort(400, message="Invalid cursor!")
+    return priority, sort_key, entry_id
+
+
+def iterate_with_time_limit(query, seconds):
+    """Go through the results of a query without keeping them around.
+    Getting each result is subject to the time limit."""
+    with time_limit(seconds):
+        # Note: this already looks for the first result
+        results = query.execute()
+    while True:
+        with time_limit(seconds):
+            try:
+                # Note: unlike iterating normally, this does not
+                # cache the results.
+                result = results.iterate()
+            except StopIteration:
+                return
+        yield result
+
+
+def prefetch_in_batches(entries, batch_size=100):
+    "Load related objects for a few entries at a time, see Entry.prefetch"
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) == batch_size:
+            yield from Entry.prefetch(batch)
+            batch = []
+    yield from Entry.prefetch(batch)
+
+
+def stream_entries(logbook, entries, n, ranked, sort_by_timestamp):
+    """Produce the same JSON as a normal entries response, in pieces.
+    If the search takes too long, we can't return an error status
+    since it's already been sent. Instead the document gets an "error"
+    member, and the cursor points to where it stopped."""
+    yield '{{"logbook": {}, "entries": ['.format(
+        json.dumps(marshal(logbook, fields.logbook)))
+    entry_fields = fields.ranked_entry if ranked else fields.short_entry
+    count = 0
+    entry = None
+    error = None
+    try:
+        for entry in prefetch_in_batches(entries):
+            if count:
+                yield ", "
+            yield json.dumps(marshal(entry, entry_fields))
+            count += 1
+    except SearchTimeout:
+        error = "timeout"
+    if entry is not None and (count == n or error) and not ranked:
+        next_cursor = encode_cursor(entry.get_sort_position(sort_by_timestamp))
+    else:
+        next_cursor = None
+    if error:
+        yield '], "next_cursor": {}, "error": {}}}\n'.format(
+            json.dumps(next_cursor), json.dumps(error))
+    else:
+        yield '], "next_cursor": {}}}\n'.format(json.dumps(next_cursor))
+
+
+def stream_entries_ndjson(entries, ranked):
+    """Produce one line of JSON per entry. If the search takes too
+    long, the last line is an error."""
+    entry_fields = fields.ranked_entry if ranked else fields.short_entry
+    try:
+        for entry in prefetch_in_batches(entries):
+            yield json.dumps(marshal(entry, entry_fields)) + "\n"
+    except SearchTimeout:
+        yield json.dumps({"error": "timeout"}) + "\n"
+
+
 class EntriesResource(Resource):
 
     "Handle requests for entries from a given logbook, optionally filtered"
 
+    @cached_response()
     @use_args(entries_args)
     def get(self, args, logbook_id=None):
 
@@ -159,6 +264,26 @@ class EntriesResource(Resource):
         metadata = [meta.split(":")
                     for meta in args.get("metadata", [])]
 
+        # The cursor is an alternative to offset, for getting the page
+        # after the one where it came from.
+        if args.get("cursor"):
+            if args["ranked"]:
+                abort(400, message="Can't use a cursor with ranked search!")
+            after = decode_cursor(args["cursor"])
+        else:
+            after = None
+
+        if args["ranked"]:
+            # The ranking is done by the full-text index, so it only
+            # works on word searches (see Entry.search). Rather than
+            # quietly returning unranked results, refuse.
+            word_filters = [fulltext_query(column, args[column])
+                            for column in ["content", "title"]
+                            if args.get(column)]
+            if not word_filters or not all(word_filters):
+                abort(400, message=("Ranking only works when searching"
+                                    " for words in content or title!"))
+
         if logbook_id:
             # restrict search to the given logbook and its descendants
             logbook = Logbook.get(Logbook.id == logbook_id)
@@ -170,7 +295,8 @@ class EntriesResource(Resource):
                                attribute_filter=attributes,
                                metadata_filter=metadata,
                                n=args["n"], offset=args.get("offset"),
-                               sort_by_timestamp=args.get("sort_by_timestamp"))
+                               sort_by_timestamp=args.get("sort_by_timestamp"),
+                               ranked=args["ranked"], after=after)
             entries = logbook.get_entries(**search_args)
         else:
             # global search (all logbooks)
@@ -183,9 +309,31 @@ class EntriesResource(Resource):
                                attribute_filter=attributes,
                                metadata_filter=metadata,
                                n=args["n"], offset=args.get("offset"),
-                               sort_by_timestamp=args.get("sort_by_timestamp"))
+                               sort_by_timestamp=args.get("sort_by_timestamp"),
+                               ranked=args["ranked"], after=after)
             entries = Entry.search(**search_args)
 
+        if args.get("stream") and args.get("download") != "pdf":
+            # Send the entries as they come out of the database, so
+            # that we don't need to keep them all in memory at once.
+            entries = iterate_with_time_limit(
+                entries, current_app.config.get("SEARCH_TIME_LIMIT"))
+            if args["stream"] == "ndjson":
+                return Response(
+                    stream_with_context(stream_entries_ndjson(
+                        entries, args["ranked"])),
+                    mimetype="application/x-ndjson")
+            return Response(
+                stream_with_context(stream_entries(
+                    logbook, entries, args["n"], args["ranked"],
+                    args["sort_by_timestamp"])),
+                mimetype="application/json")
+
+        # Don't let a slow search (e.g. a bad regexp) hog the server
+        with time_limit(current_app.config.get("SEARCH_TIME_LIMIT")):
+            entries = list(entries)
+        Entry.prefetch(entries)
+
         if args.get("download") == "pdf":
             # return a PDF version
             # TODO: not sure if this belongs in the API
@@ -197,8 +345,16 @@ class EntriesResource(Resource):
                              attachment_filename=("{logbook.name}.pdf"
                                                   .format(logbook=logbook)))
 
-        return marshal(dict(logbook=logbook,
-                            entries=list(entries)), fields.entries)
+        if entries and len(entries) == args["n"] and not args["ranked"]:
+            # there may be more results
+            next_cursor = encode_cursor(entries[-1].get_sort_position(
+                args["sort_by_timestamp"]))
+        else:
+            next_cursor = None
+        return marshal(dict(logbook=logbook, entries=entries,
+                            next_cursor=next_cursor),
+                       fields.ranked_entries if args["ranked"]
+                       else fields.entries)
 
 
 class EntryLockResource(Resource):
@@ -212,6 +368,7 @@ class EntryLockResource(Resource):
             return lock
         raise EntryLock.DoesNotExist
 
+    @send_signal(new_lock)
     @use_args({"steal": Boolean(missing=False)})
     @marshal_with(fields.entry_lock, envelope="lock")
     def post(self, args, entry_id, logbook_id=None):
@@ -221,6 +378,7 @@ class EntryLockResource(Resource):
                               acquire=True,
                               steal=args["steal"])
 
+    @send_signal(cancel_lock)
     @use_args({"lock_id": Integer()})
     @marshal_with(fields.entry_lock, envelope="lock")
     def delete(self, args, entry_id=None, logbook_id=None):
@@ -239,4 +397,16 @@ class EntryChangesResource(Resource):
     @marshal_with(fields.entry_changes)
     def get(self, entry_id, logbook_id=None):
         entry = Entry.get(Entry.id == entry_id)
-        return {"entry_changes": entry.changes}
+        return {"entry_changes": entry.get_changes()}
+
+
+class EntryDiffResource(Resource):
+
+    @use_args({"from": Integer(required=True), "to": Integer()})
+    @marshal_with(fields.entry_diff, envelope="diff")
+    def get(self, args, entry_id, logbook_id=None):
+        "Get the differences between two revisions of the content"
+        entry = Entry.get(Entry.id == entry_id)
+        to_version = args.get("to", entry.revision_n)
+        return {"from": args["from"], "to": to_version,
+                "content": entry.get_diff(args["from"], to_version)}
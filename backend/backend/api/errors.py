@@ -14,6 +14,10 @@ errors = {
         message="Group does not exist!",
         status=404
     ),
+    "Conflict": dict(
+        message="Conflict: it has been edited since you last loaded it!",
+        status=409
+    ),
     "Locked": dict(
         message="Resource locked by someone else!",
         status=409
@@ -25,5 +29,17 @@ errors = {
     "EntryRevisionDoesNotExist": dict(
         message="Entry revision does not exist!",
         status=404
+    ),
+    "EntryChangeDoesNotExist": dict(
+        message="Entry revision does not exist!",
+        status=404
+    ),
+    "BadRegexp": dict(
+        message="The search pattern can't be used, try a simpler one!",
+        status=400
+    ),
+    "SearchTimeout": dict(
+        message="The search took too long, try making it more specific!",
+        status=503
     )
 }
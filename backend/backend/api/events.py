@@ -0,0 +1,254 @@
+"""
+Live updates to clients, using Server-Sent Events.
+
+Clients subscribe to the events of a logbook (including its
+descendants) and get told when entries are created or edited, or
+locked or unlocked, so that they only need to fetch what changed.
+The events are kept small; just enough to know what to fetch.
+
+The events are found by looking in the database (see ChangePoller),
+so changes made by other processes (or scripts) get through too. The
+signals sent by this process just make that happen sooner.
+
+Each connection just waits for events most of the time, so this is
+meant to be run with gevent (see the Dockerfile), where an idle
+connection is cheap.
+"""
+
+import json
+import logging
+from queue import Queue, Empty, Full
+from threading import Event, Lock, Thread
+
+from flask import Response
+from flask_restful import Resource
+from flask_restful.fields import DateTime
+
+from ..actions import new_entry, edit_entry, new_lock, cancel_lock
+from ..db import ChangeSequence, Entry, EntryLock, LogbookClosure
+
+
+# How often to send something to idle clients, to keep the connection
+# open, and to find out if they have gone away.
+KEEPALIVE_INTERVAL = 20
+
+# How long clients should wait before reconnecting, in ms
+RETRY_INTERVAL = 5000
+
+# How often to look for changes made by other processes, in seconds
+POLL_INTERVAL = 1
+
+
+class Subscription:
+
+    "A client listening to events from a logbook (or all logbooks)"
+
+    # Events are dropped if the client can't keep up, and it gets
+    # told to reload everything instead.
+    MAX_QUEUED = 100
+
+    def __init__(self, logbook_id=None):
+        self.logbook_id = logbook_id
+        self.queue = Queue(self.MAX_QUEUED)
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except Full:
+            with self.queue.mutex:
+                self.queue.queue.clear()
+            self.queue.put_nowait({"type": "reset"})
+
+    def get(self, timeout):
+        return self.queue.get(timeout=timeout)
+
+
+class EventBroker:
+
+    "Keeps track of subscriptions, and hands out events to them"
+
+    def __init__(self):
+        self._subscriptions = set()
+        self._lock = Lock()
+
+    def subscribe(self, logbook_id=None):
+        subscription = Subscription(logbook_id)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    @property
+    def has_subscriptions(self):
+        return bool(self._subscriptions)
+
+    def publish(self, event, logbook_ids):
+        "Send the event to anyone listening to one of the logbooks"
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            if (subscription.logbook_id is None or
+                    subscription.logbook_id in logbook_ids):
+                subscription.put(event)
+
+
+broker = EventBroker()
+
+
+def get_logbook_ids(logbook_id):
+    "The given logbook, and all its ancestors"
+    return {row.ancestor_id
+            for row in (LogbookClosure.select(LogbookClosure.ancestor)
+                        .where(LogbookClosure.descendant == logbook_id))}
+
+
+def format_time(value):
+    return DateTime().format(value) if value else None
+
+
+class ChangePoller:
+
+    """
+    Looks in the database for entries and locks that have changed,
+    and publishes events about them. There is one per process, which
+    only does anything while there are subscribers. Entries are found
+    through their change_seq, and locks through their ids (new ones)
+    and cancel times (cancelled ones). Note that an entry that has
+    never been edited counts as new, even if it's only its attachments
+    that changed; either way clients just need to fetch it.
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._thread = None
+        self._reset()
+
+    def _reset(self):
+        self.change_seq = self.lock_id = self.cancelled_at = None
+
+    def start(self):
+        """Make sure we're running, and that changes made from now on
+        will be seen. Call this when a client subscribes."""
+        with self._lock:
+            if self.change_seq is None:
+                self.change_seq = ChangeSequence.current()
+                self.lock_id = (EntryLock.select(EntryLock.id)
+                                .order_by(EntryLock.id.desc())
+                                .scalar()) or 0
+                latest = (EntryLock.select(EntryLock.cancelled_at)
+                          .where(EntryLock.cancelled_at != None)
+                          .order_by(EntryLock.cancelled_at.desc())
+                          .first())
+                self.cancelled_at = latest and latest.cancelled_at
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="event-poller",
+                                      daemon=True)
+                self._thread.start()
+
+    def wake(self, *args, **kwargs):
+        "Look for changes right away"
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(POLL_INTERVAL)
+            self._wakeup.clear()
+            try:
+                self.poll()
+            except Exception as e:
+                logging.error("Failed to look for changes: %s", e)
+
+    def poll(self):
+        with self._lock:
+            if not self.broker.has_subscriptions:
+                # nobody is listening; start over when someone is
+                self._reset()
+                return
+            if self.change_seq is None:
+                return
+            self._poll_entries()
+            self._poll_locks()
+
+    def _poll_entries(self):
+        _, entries, self.change_seq = ChangeSequence.get_changed(
+            self.change_seq)
+        for entry in entries:
+            event = dict(type="edit_entry" if entry.revision_n
+                         else "new_entry",
+                         entry_id=entry.id, logbook_id=entry.logbook_id,
+                         follows_id=entry.follows_id,
+                         revision_n=entry.revision_n,
+                         change_seq=entry.change_seq,
+                         timestamp=format_time(entry.last_changed_at or
+                                               entry.created_at))
+            self.broker.publish(event, get_logbook_ids(entry.logbook_id))
+
+    def _poll_locks(self):
+        condition = EntryLock.id > self.lock_id
+        if self.cancelled_at is not None:
+            condition |= EntryLock.cancelled_at > self.cancelled_at
+        else:
+            condition |= EntryLock.cancelled_at != None
+        locks = (EntryLock.select(EntryLock,
+                                  Entry.logbook.alias("logbook_id"))
+                 .join(Entry)
+                 .where(condition)
+                 .order_by(EntryLock.id)
+                 .naive())
+        for lock in locks:
+            if lock.id > self.lock_id:
+                self.lock_id = lock.id
+                self._publish_lock("lock", lock)
+            if lock.cancelled_at is not None:
+                if (self.cancelled_at is None or
+                        lock.cancelled_at > self.cancelled_at):
+                    self.cancelled_at = lock.cancelled_at
+                self._publish_lock("unlock", lock)
+
+    def _publish_lock(self, event_type, lock):
+        event = dict(type=event_type, entry_id=lock.entry_id,
+                     logbook_id=lock.logbook_id, lock_id=lock.id)
+        self.broker.publish(event, get_logbook_ids(lock.logbook_id))
+
+
+poller = ChangePoller(broker)
+
+for signal in [new_entry, edit_entry, new_lock, cancel_lock]:
+    signal.connect(poller.wake, weak=False)
+
+
+def stream_events(subscription):
+    try:
+        # send something right away, so that the client knows
+        # it's connected
+        yield "retry: {}\n\n".format(RETRY_INTERVAL)
+        while True:
+            try:
+                event = subscription.get(timeout=KEEPALIVE_INTERVAL)
+            except Empty:
+                yield ": keepalive\n\n"
+                continue
+            yield "event: {}\ndata: {}\n\n".format(event["type"],
+                                                  json.dumps(event))
+    finally:
+        # the client has gone away
+        broker.unsubscribe(subscription)
+
+
+class EventsResource(Resource):
+
+    def get(self, logbook_id=None):
+        "Listen to events from a logbook and its descendants"
+        subscription = broker.subscribe(logbook_id)
+        poller.start()
+        # Note: not using stream_with_context, since we don't want
+        # to hold on to the request, or the database connection.
+        return Response(stream_events(subscription),
+                        mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache",
+                                 "X-Accel-Buffering": "no"})
@@ -1,10 +1,14 @@
-from collections import OrderedDict
+from datetime import datetime
 from dateutil.parser import parse
+from html import escape
 import json
 
-from flask_restful import fields, marshal, marshal_with_field
+from flask_restful import fields, marshal_with_field
 import lxml
 
+from ..db import SNIPPET_MATCH_START, SNIPPET_MATCH_END
+from .serialize import marshal
+
 
 class NumberOf(fields.Raw):
     def format(self, value):
@@ -65,7 +69,9 @@ logbook = {
     "children": NonArchivedList(LogbookField),
     "attributes": fields.List(fields.Nested(attribute)),
     "metadata": fields.Raw,
-    "archived": fields.Boolean
+    "archived": fields.Boolean,
+    "revision_n": fields.Integer,
+    "change_seq": fields.Integer
 }
 
 
@@ -130,6 +136,7 @@ class EntryId(fields.Raw):
 
 entry_lock = {
     "id": fields.Integer,
+    "entry_id": fields.Integer,
     "created_at": fields.DateTime,
     "expires_at": fields.DateTime,
     "owned_by_ip": fields.String,
@@ -174,6 +181,7 @@ entry_full = {
     "n_followups": NumberOf(attribute="followups"),
     "followups": NonArchivedList(Followup),
     "revision_n": fields.Integer,
+    "change_seq": fields.Integer,
     "lock": fields.Nested(entry_lock, allow_null=True),
     "next": EntryId,
     "previous": EntryId,
@@ -201,7 +209,7 @@ class EntryChangeField(fields.Raw):
             field: dict(old=change.get_old_value(field),
                         new=change.get_new_value(field))
             for field in ["title", "content", "authors", "attributes"]
-            if field in change.changed
+            if field in change.changed_fields
         }
         meta_fields = marshal(change, entrychange_metadata)
         return {
@@ -215,6 +223,13 @@ entry_changes = {
 }
 
 
+entry_diff = {
+    "from": fields.Integer,
+    "to": fields.Integer,
+    "content": fields.String
+}
+
+
 class FirstIfAny(fields.Raw):
     def format(self, value):
         if value:
@@ -222,6 +237,19 @@ class FirstIfAny(fields.Raw):
 
 
 class ContentPreview(fields.Raw):
+    def output(self, key, obj):
+        # ranked search results come with a ready made snippet of text
+        snippet = getattr(obj, "snippet", None)
+        if snippet is not None:
+            return (snippet.replace(SNIPPET_MATCH_START, "")
+                    .replace(SNIPPET_MATCH_END, "")
+                    .strip().replace("\n", " "))
+        # normally the preview is stored with the entry
+        preview = getattr(obj, "preview", None)
+        if preview is not None:
+            return preview
+        return super().output(key, obj)
+
     def format(self, value):
         value = value.strip()
         if value:
@@ -230,8 +258,25 @@ class ContentPreview(fields.Raw):
             return raw_text[:200].strip().replace("\n", " ")
 
 
+class SnippetField(fields.Raw):
+    "Search result snippet as HTML, with the matches highlighted"
+    def format(self, value):
+        return (escape(value.strip().replace("\n", " "))
+                .replace(SNIPPET_MATCH_START, "<mark>")
+                .replace(SNIPPET_MATCH_END, "</mark>"))
+
+
 class DateTimeFromStringField(fields.DateTime):
+
+    # the formats sqlite uses, which are much quicker to parse
+    FORMATS = ["%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"]
+
     def format(self, value):
+        for fmt in self.FORMATS:
+            try:
+                return super().format(datetime.strptime(value, fmt))
+            except ValueError:
+                pass
         return super().format(parse(value))
 
 
@@ -243,9 +288,8 @@ logbook_very_short = {
 
 class FollowupAuthorsField(fields.Raw):
     def format(self, value):
-        all_authors = sum(json.loads(value), [])
-        d = OrderedDict((author["name"], None) for author in all_authors)
-        return list(d.keys())
+        # already a list of unique names, see EntrySummary
+        return json.loads(value)
 
 
 short_entry = {
@@ -261,14 +305,73 @@ short_entry = {
     "attributes": fields.Raw,
     "followup_authors": FollowupAuthorsField(),
     "attachment_preview": FirstIfAny(attribute="attachments"),
-    "n_attachments": NumberOf(attribute="attachments"),
+    "n_attachments": fields.Integer,
     "n_followups": fields.Integer
 }
 
 
+# ranked search results also have a snippet
+ranked_entry = dict(short_entry, snippet=SnippetField)
+
+
 entries = {
     "logbook": fields.Nested(logbook),
     "entries": fields.List(fields.Nested(short_entry)),
+    "next_cursor": fields.String,
+}
+
+ranked_entries = dict(entries,
+                      entries=fields.List(fields.Nested(ranked_entry)))
+
+
+changed_logbook = {
+    "id": fields.Integer,
+    "parent_id": fields.Integer,
+    "change_seq": fields.Integer,
+    "revision_n": fields.Integer,
+    "created_at": fields.DateTime,
+    "last_changed_at": fields.DateTime,
+    "archived": fields.Boolean
+}
+
+
+changed_entry = {
+    "id": fields.Integer,
+    "logbook_id": fields.Integer,
+    "follows_id": fields.Integer,
+    "change_seq": fields.Integer,
+    "revision_n": fields.Integer,
+    "created_at": fields.DateTime,
+    "last_changed_at": fields.DateTime,
+    "archived": fields.Boolean
+}
+
+
+changed = {
+    "logbooks": fields.List(fields.Nested(changed_logbook)),
+    "entries": fields.List(fields.Nested(changed_entry)),
+    "cursor": fields.Integer
+}
+
+
+action_stats = {
+    "signal": fields.String,
+    "waiting": fields.Integer(default=0),
+    "running": fields.Integer(default=0),
+    "failed": fields.Integer(default=0),
+    "oldest": fields.DateTime,
+    "succeeded": fields.Integer,
+    "errors": fields.Integer,
+    "latency": fields.Float,
+    "max_latency": fields.Float,
+    "duration": fields.Float,
+    "max_duration": fields.Float
+}
+
+
+actions = {
+    "workers": fields.Integer,
+    "actions": fields.List(fields.Nested(action_stats))
 }
 
 
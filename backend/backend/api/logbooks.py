@@ -1,10 +1,15 @@
-from flask_restful import Resource, marshal_with
+from collections import OrderedDict
+from threading import Lock
+
+from flask_restful import Resource, abort
 from webargs.fields import Integer, Str, Boolean, Dict, List, Nested
 from webargs.flaskparser import use_args
 
-from ..db import Logbook
-from ..actions import new_logbook, edit_logbook
+from ..db import db, Logbook, LogbookClosure, EntryAuthor
+from ..actions import new_logbook, edit_logbook, data_changed
 from . import fields, send_signal
+from .cache import cached_response
+from .serialize import marshal, marshal_with
 
 
 logbook_args = {
@@ -24,34 +29,77 @@ logbook_args = {
         "options": List(Str(), missing=None)
     })),
     "metadata": Dict(),
-    "archived": Boolean(missing=False)
+    "archived": Boolean(missing=False),
+    "revision_n": Integer()
 }
 
 
+# The whole tree of logbooks is needed all the time, and rarely
+# changes, so we keep it around, ready to send. It's thrown away
+# whenever a logbook is created or changed. The generation is
+# increased on every change, so that a tree that was made from data
+# that changed meanwhile isn't kept (like in ResponseCache).
+_logbook_tree = dict(tree=None, generation=0)
+_logbook_tree_lock = Lock()
+
+
+def get_logbook_tree():
+    "Get the marshalled logbook tree, and an index of its logbooks by id"
+    with _logbook_tree_lock:
+        cached = _logbook_tree["tree"]
+        generation = _logbook_tree["generation"]
+    if cached is not None:
+        return cached
+    tree = marshal(dict(children=Logbook.get_tree()), fields.logbook)
+    index = {}
+    nodes = list(tree["children"])
+    while nodes:
+        node = nodes.pop()
+        index[node["id"]] = node
+        nodes.extend(node["children"])
+    with _logbook_tree_lock:
+        if generation == _logbook_tree["generation"]:
+            _logbook_tree["tree"] = tree, index
+    return tree, index
+
+
+def clear_logbook_tree(sender, **kwargs):
+    with _logbook_tree_lock:
+        _logbook_tree["generation"] += 1
+        _logbook_tree["tree"] = None
+
+
+new_logbook.connect(clear_logbook_tree)
+edit_logbook.connect(clear_logbook_tree)
+data_changed.connect(clear_logbook_tree)
+
+
 class LogbooksResource(Resource):
 
     "Handle requests for logbooks"
 
+    @cached_response()
     @use_args({"parent": Integer()})
-    @marshal_with(fields.logbook, envelope="logbook")
     def get(self, args, logbook_id=None, revision_n=None):
 
         "Fetch a given logbook"
 
-        if logbook_id:
+        if logbook_id and revision_n is not None:
             logbook = Logbook.get(Logbook.id == logbook_id)
-            if revision_n is not None:
-                return logbook.get_revision(revision_n)
-            return logbook
-
-        # Get either the direct children of a given parent, or else the
-        # global list of top-level (no parent) logbooks
-        parent_id = args.get("parent")
-        if parent_id:
-            return Logbook.get(Logbook.id == parent_id)
-        children = (Logbook.select()
-                    .where(Logbook.parent == None))
-        return dict(children=children)
+            return marshal(logbook.get_revision(revision_n), fields.logbook,
+                           envelope="logbook")
+
+        # Get either the given logbook, the direct children of a given
+        # parent, or else the global list of top-level (no parent) logbooks
+        tree, index = get_logbook_tree()
+        logbook_id = logbook_id or args.get("parent")
+        if not logbook_id:
+            return OrderedDict(logbook=tree)
+        if logbook_id in index:
+            return OrderedDict(logbook=index[logbook_id])
+        # archived logbooks are not in the tree
+        logbook = Logbook.get(Logbook.id == logbook_id)
+        return marshal(logbook, fields.logbook, envelope="logbook")
 
     @send_signal(new_logbook)
     @use_args(logbook_args)
@@ -88,9 +136,22 @@ class LogbooksResource(Resource):
         else:
             # make sure the parent exists
             Logbook.get(Logbook.id == args["parent_id"])
+            # ...and that it's not the logbook itself, or inside it
+            if (LogbookClosure.select()
+                    .where((LogbookClosure.ancestor == logbook_id) &
+                           (LogbookClosure.descendant == args["parent_id"]))
+                    .exists()):
+                abort(400, message=("Can't move a logbook into itself"
+                                    " or one of its descendants!"))
         logbook = Logbook.get(Logbook.id == logbook_id)
-        logbook.make_change(**args).save()
-        logbook.save()
+        # if the client tells us which revision it is editing, we can
+        # make sure that it has not been changed by someone else.
+        revision_n = args.pop("revision_n", None)
+        if revision_n is not None and revision_n != logbook.revision_n:
+            raise Logbook.Conflict()
+        with db.atomic():
+            logbook.make_change(**args).save()
+            logbook.save()
         return logbook
 
 
@@ -99,4 +160,15 @@ class LogbookChangesResource(Resource):
     @marshal_with(fields.logbook_changes)
     def get(self, logbook_id):
         logbook = Logbook.get(Logbook.id == logbook_id)
-        return {"logbook_changes": logbook.changes}
+        return {"logbook_changes": logbook.get_changes()}
+
+
+class LogbookAuthorsResource(Resource):
+
+    "The authors that have written entries in a logbook"
+
+    @use_args({"search": Str(missing="")})
+    @marshal_with(fields.user, envelope="authors")
+    def get(self, args, logbook_id):
+        logbook = Logbook.get(Logbook.id == logbook_id)
+        return EntryAuthor.search(args["search"], logbook=logbook)
@@ -8,6 +8,7 @@ try:
 except ImportError:
     ldap = None
 
+from ..db import EntryAuthor
 from . import fields
 
 
@@ -48,6 +49,8 @@ class GroupDoesNotExist(Exception):
     pass
 
 
+MAX_RESULTS = 20
+
 users_parser = reqparse.RequestParser()
 users_parser.add_argument("search", type=str, default="")
 users_parser.add_argument("groups", type=str, default="")
@@ -61,6 +64,10 @@ class UsersResource(Resource):
     it just stores the authors as arbitrary strings. This is intended
     as a convenient way look up user names, not for authentication.
 
+    Authors that have been used in entries before are looked up first,
+    since that is quick and they are likely to be relevant. Only if
+    there are not enough of those do we ask the system.
+
     search: arbitrary string that will be matched against logins and
             full names.
     groups: a list of group names to restrict the search to
@@ -75,11 +82,28 @@ class UsersResource(Resource):
         if not search:
             return []
 
+        # first check the authors of existing entries, unless we're
+        # restricted to some groups (which we don't know about here)
+        if args.get("groups"):
+            candidates = []
+        else:
+            candidates = EntryAuthor.search(search, n=MAX_RESULTS)
+            if len(candidates) >= MAX_RESULTS:
+                return candidates
+        known_names = set(c["name"].lower() for c in candidates)
+        for user in self.search_system(search, args):
+            if user.get("name", "").lower() not in known_names:
+                candidates.append(user)
+        return candidates[:MAX_RESULTS]
+
+    def search_system(self, search, args):
+
         # if LDAP is configured, let's check that
         LDAP_SERVER = current_app.config.get("LDAP_SERVER")
         LDAP_BASEDN = current_app.config.get("LDAP_BASEDN")
         if LDAP_SERVER and LDAP_BASEDN:
-            return search_ldap(LDAP_SERVER, LDAP_BASEDN, search)
+            return search_ldap(LDAP_SERVER, LDAP_BASEDN, search,
+                               max_results=MAX_RESULTS)
 
         # otherwise check for local users
         groups = args.get("groups", [])
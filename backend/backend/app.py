@@ -4,17 +4,25 @@ The main entrypoint of the Elogy web application
 
 from time import time
 
+import click
 from flask import Flask, current_app, send_from_directory, g, request
 from flask_restful import Api
 import logging
 
 from .api.errors import errors as api_errors
-from .api.logbooks import LogbooksResource, LogbookChangesResource
+from .api.logbooks import (LogbooksResource, LogbookChangesResource,
+                           LogbookAuthorsResource)
 from .api.entries import (EntryResource, EntriesResource,
-                          EntryLockResource, EntryChangesResource)
+                          EntryLockResource, EntryChangesResource,
+                          EntryDiffResource)
 from .api.users import UsersResource
 from .api.attachments import AttachmentsResource
-from .db import setup_database
+from .api.events import EventsResource
+from .api.changes import ChangesResource
+from .api.actions import ActionsResource
+from .actions import data_changed, workers
+from .db import (db, setup_database, database_changed, Entry, EntryChange,
+                 LogbookClosure)
 from .admin import setup_admin
 
 
@@ -30,6 +38,17 @@ app.secret_key = app.config["SECRET"]
 @app.before_request
 def before_request():
     g.start = time()
+    # there may be several processes serving requests, and then
+    # we need to make sure caches don't go stale.
+    if database_changed():
+        data_changed.send()
+
+
+@app.before_first_request
+def start_workers():
+    # there may be actions left in the queue since last time
+    if any(app.config.get("ACTIONS", {}).values()):
+        workers.start(app)
 
 
 @app.teardown_request
@@ -42,6 +61,50 @@ setup_database(app.config["DATABASE"]["name"])
 setup_admin(app)
 
 
+# command line tools, run e.g. "flask check-logbooks"
+@app.cli.command("check-logbooks")
+@click.option("--rebuild", is_flag=True,
+              help="Recreate the logbook hierarchy table if it's broken.")
+def check_logbooks(rebuild):
+    "Check that the logbook hierarchy table is consistent."
+    missing, extra = LogbookClosure.check()
+    for ancestor, descendant, depth in missing:
+        click.echo("Missing: {} -> {} (depth {})"
+                   .format(ancestor, descendant, depth))
+    for ancestor, descendant, depth in extra:
+        click.echo("Extra: {} -> {} (depth {})"
+                   .format(ancestor, descendant, depth))
+    if not (missing or extra):
+        click.echo("Logbook hierarchy OK")
+    elif rebuild:
+        LogbookClosure.rebuild()
+        click.echo("Logbook hierarchy rebuilt")
+
+
+@app.cli.command("backfill-text")
+def backfill_text():
+    "Store the plain text and preview of entries created before they were."
+    n = Entry.backfill_text()
+    click.echo("Updated {} entries".format(n))
+
+
+@app.cli.command("compact-history")
+@click.option("--vacuum", is_flag=True,
+              help="Also rebuild the database file, to free up space.")
+def compact_history(vacuum):
+    "Store the content history of entries as patches."
+    entries = (Entry.select()
+               .join(EntryChange)
+               .group_by(Entry.id))
+    n = 0
+    for entry in entries:
+        with db.atomic():
+            n += EntryChange.compact_entry(entry)
+    click.echo("Rewrote {} changes".format(n))
+    if vacuum:
+        db.execute_sql("VACUUM")
+
+
 # Allow CORS requests. Maybe we should only enable this in debug mode?
 @app.after_request
 def per_request_callbacks(response):
@@ -61,6 +124,9 @@ api.add_resource(LogbooksResource,
 api.add_resource(LogbookChangesResource,
                  "/logbooks/<int:logbook_id>/revisions/")
 
+api.add_resource(LogbookAuthorsResource,
+                 "/logbooks/<int:logbook_id>/authors/")
+
 api.add_resource(EntriesResource,
                  "/logbooks/<int:logbook_id>/entries/")  # GET
 
@@ -74,6 +140,10 @@ api.add_resource(EntryResource,
 api.add_resource(EntryChangesResource,
                  "/logbooks/<int:logbook_id>/entries/<int:entry_id>/revisions/")
 
+api.add_resource(EntryDiffResource,
+                 "/logbooks/<int:logbook_id>/entries/<int:entry_id>/diff/",
+                 "/entries/<int:entry_id>/diff/")
+
 api.add_resource(EntryLockResource,
                  "/logbooks/<int:logbook_id>/entries/<int:entry_id>/lock",
                  "/entries/<int:entry_id>/lock")
@@ -86,6 +156,17 @@ api.add_resource(AttachmentsResource,
                  "/logbooks/<int:logbook_id>/entries/<int:entry_id>/attachments/<int:attachment_id>",
                  "/attachments/")
 
+api.add_resource(EventsResource,
+                 "/logbooks/<int:logbook_id>/events/",
+                 "/events/")
+
+api.add_resource(ChangesResource,
+                 "/logbooks/<int:logbook_id>/changes/",
+                 "/changes/")
+
+api.add_resource(ActionsResource,
+                 "/actions/")
+
 
 # other routes
 @app.route('/attachments/<path:path>')
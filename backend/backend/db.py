@@ -1,15 +1,27 @@
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from functools import lru_cache
 from html.parser import HTMLParser
 import json
 import logging
+import re
+import sre_constants
+import sre_parse
 import sys
+from threading import Lock, local
+from time import monotonic, sleep
 
 from flask import url_for
-from playhouse.sqlite_ext import SqliteExtDatabase, JSONField, fn
+from playhouse.sqlite_ext import (SqliteExtDatabase, JSONField, fn,
+                                  FTS5Model, SearchField)
+from playhouse.migrate import SqliteMigrator, migrate
 from peewee import (IntegerField, CharField, TextField, BooleanField,
                     DateTimeField, ForeignKeyField, sqlite3)
-from peewee import Model, DoesNotExist, Entity
+from peewee import (Model, DoesNotExist, Entity, CompositeKey, SQL,
+                    OperationalError)
 
+from .htmldiff import htmldiff, TextMatcher
+from .patch import make_patch, apply_patch
 from .utils import CustomJSONEncoder
 
 
@@ -17,6 +29,393 @@ from .utils import CustomJSONEncoder
 db = SqliteExtDatabase(None)
 
 
+# If a search filter contains any of these, we treat it as a regexp
+REGEXP_CHARACTERS = set(".^$*+?{}[]\\|()")
+
+
+# A single regexp search can't be interrupted (see time_limit), and
+# some patterns take practically forever on long enough texts. So we
+# don't accept long patterns, or the worst kinds (see check_regexp),
+# and long texts are searched a piece at a time (see compile_regexp).
+MAX_REGEXP_LENGTH = 200
+# each extra repeat (e.g. ".*") makes the worst case a lot slower
+MAX_REGEXP_REPEATS = 3
+# Roughly how many steps the regexp engine may need, at worst, for
+# each piece of a long text.
+REGEXP_WINDOW_COST = 3 * 10 ** 6
+
+
+class BadRegexp(Exception):
+    pass
+
+
+REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+MAXREPEAT = sre_constants.MAXREPEAT
+
+# The characters we look at when checking if parts of a regexp can
+# match the same thing. The rest of unicode is not likely to matter.
+_ALPHABET = frozenset(map(chr, range(0x250)))
+_CATEGORIES = {
+    getattr(sre_constants, "CATEGORY_" + name): frozenset(
+        char for char in _ALPHABET if re.match(regexp, char))
+    for name, regexp in [("DIGIT", r"\d"), ("NOT_DIGIT", r"\D"),
+                         ("SPACE", r"\s"), ("NOT_SPACE", r"\S"),
+                         ("WORD", r"\w"), ("NOT_WORD", r"\W")]
+}
+# things that look past the end of the match
+_LOOKING_AHEAD = (sre_constants.AT_END, sre_constants.AT_END_STRING,
+                  sre_constants.AT_BOUNDARY, sre_constants.AT_NON_BOUNDARY)
+
+
+def _subpatterns(op, arg):
+    "The parts of a parsed regexp that contain further patterns"
+    if op == sre_constants.SUBPATTERN:
+        # the group contents are the last item, regardless of version
+        return [arg[-1]]
+    if op == sre_constants.BRANCH:
+        return arg[1]
+    if op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+        return [arg[1]]
+    if op == sre_constants.GROUPREF_EXISTS:
+        return [item for item in arg[1:] if item is not None]
+    if op in REPEATS:
+        return [arg[2]]
+    return []
+
+
+def _flatten(parsed):
+    "The items of a parsed regexp, with the contents of groups inlined"
+    for op, arg in parsed:
+        if op == sre_constants.SUBPATTERN:
+            yield from _flatten(arg[-1])
+        else:
+            yield op, arg
+
+
+def _literal(code):
+    # we always search case insensitively
+    char = chr(code)
+    return {char, char.lower(), char.upper()}
+
+
+def _char_set(op, arg):
+    """The characters that a single character item can match, or None
+    if it's not such an item."""
+    if op == sre_constants.LITERAL:
+        return _literal(arg)
+    if op == sre_constants.NOT_LITERAL:
+        return _ALPHABET - _literal(arg)
+    if op == sre_constants.ANY:
+        return _ALPHABET - {"\n"}
+    if op == sre_constants.CATEGORY:
+        return _CATEGORIES.get(arg)
+    if op == sre_constants.IN:
+        chars = set()
+        negate = False
+        for item_op, item_arg in arg:
+            if item_op == sre_constants.NEGATE:
+                negate = True
+            elif item_op == sre_constants.RANGE:
+                low, high = item_arg
+                for code in range(low, min(high, 0x24f) + 1):
+                    chars |= _literal(code)
+            else:
+                item_chars = _char_set(item_op, item_arg)
+                if item_chars is None:
+                    return None
+                chars |= item_chars
+        return _ALPHABET - chars if negate else chars
+    return None
+
+
+def _all_chars(parsed):
+    """All the characters the parsed regexp could match, or None if
+    we can't tell."""
+    chars = set()
+    for op, arg in parsed:
+        if op in (sre_constants.AT, sre_constants.ASSERT,
+                  sre_constants.ASSERT_NOT):
+            continue
+        items = _subpatterns(op, arg)
+        if items:
+            for item in items:
+                item_chars = _all_chars(item)
+                if item_chars is None:
+                    return None
+                chars |= item_chars
+            continue
+        item_chars = _char_set(op, arg)
+        if item_chars is None:
+            return None
+        chars |= item_chars
+    return chars
+
+
+def _first_chars(parsed):
+    """The characters that a match of the parsed regexp can start with
+    (or None if we can't tell), and whether it can be empty."""
+    chars = set()
+    for op, arg in parsed:
+        if op in (sre_constants.AT, sre_constants.ASSERT,
+                  sre_constants.ASSERT_NOT):
+            continue  # zero width
+        items = _subpatterns(op, arg)
+        if items:
+            can_be_empty = (op == sre_constants.GROUPREF_EXISTS and
+                            len(items) == 1)
+            for item in items:
+                item_chars, item_empty = _first_chars(item)
+                if item_chars is None:
+                    return None, False
+                chars |= item_chars
+                can_be_empty = can_be_empty or item_empty
+            if op in REPEATS and arg[0] == 0:
+                can_be_empty = True
+            if not can_be_empty:
+                return chars, False
+            continue
+        item_chars = _char_set(op, arg)
+        if item_chars is None:
+            return None, False
+        return chars | item_chars, False
+    return chars, True
+
+
+def _can_be_empty(op, arg):
+    if op in (sre_constants.AT, sre_constants.ASSERT,
+              sre_constants.ASSERT_NOT):
+        return True
+    return _first_chars([(op, arg)])[1]
+
+
+def _overlapping_branches(branches):
+    "Check if more than one of the alternatives can match at a point"
+    firsts = [_first_chars(branch) for branch in branches]
+    for i, (chars1, empty1) in enumerate(firsts):
+        for chars2, empty2 in firsts[i + 1:]:
+            if (chars1 is None or chars2 is None or chars1 & chars2 or
+                    (empty1 and empty2)):
+                return True
+    return False
+
+
+def _check_parsed(parsed, in_repeat=False):
+    """Look for the kinds of regexps that can take exponential time to
+    fail, where the text can be matched in very many different ways:
+    repeats inside repeats, e.g. "(a+)+", alternatives inside repeats
+    that can match the same thing, e.g. "(a|a)*", and repeats right
+    after each other that can match the same thing, e.g. "\\w*\\w*"."""
+    # characters of the last unbounded repeat, if it can still give
+    # characters to a following one
+    previous = None
+    for op, arg in _flatten(parsed):
+        if op in REPEATS:
+            low, high, item = arg
+            if in_repeat and high != low:
+                raise BadRegexp("Search pattern is too complex"
+                                " (nested repeats)")
+            if high == MAXREPEAT:
+                chars = _all_chars(item)
+                if chars is None:
+                    chars = _ALPHABET
+                if previous is not None and previous & chars:
+                    raise BadRegexp("Search pattern is too complex"
+                                    " (repeats of the same thing)")
+                previous = chars
+            elif low > 0 and not _can_be_empty(op, arg):
+                previous = None
+        elif not _can_be_empty(op, arg):
+            previous = None
+        if in_repeat and op == sre_constants.BRANCH:
+            if _overlapping_branches(arg[1]):
+                raise BadRegexp("Search pattern is too complex"
+                                " (alternatives in a repeat that"
+                                " match the same thing)")
+        repeats = op in REPEATS and arg[1] > 1
+        for item in _subpatterns(op, arg):
+            _check_parsed(item, in_repeat or repeats)
+
+
+def _count_repeats(parsed):
+    return sum((op in REPEATS and arg[1] > 1) +
+               sum(_count_repeats(item) for item in _subpatterns(op, arg))
+               for op, arg in parsed)
+
+
+def _looks_ahead(parsed):
+    "Check if matching may depend on what comes after the match"
+    for op, arg in parsed:
+        if op == sre_constants.AT and arg in _LOOKING_AHEAD:
+            return True
+        if (op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT) and
+                arg[0] == 1):
+            return True
+        if any(_looks_ahead(item) for item in _subpatterns(op, arg)):
+            return True
+    return False
+
+
+def _parse_regexp(pattern):
+    if len(pattern) > MAX_REGEXP_LENGTH:
+        raise BadRegexp("Search pattern is too long (max {} characters)"
+                        .format(MAX_REGEXP_LENGTH))
+    try:
+        return sre_parse.parse(pattern)
+    except (sre_constants.error, OverflowError, RecursionError) as e:
+        raise BadRegexp("Bad search pattern: {}".format(e))
+
+
+def check_regexp(pattern):
+    "Raise BadRegexp unless the pattern is OK to search with"
+    if not REGEXP_CHARACTERS.intersection(pattern):
+        if len(pattern) > MAX_REGEXP_LENGTH:
+            raise BadRegexp("Search pattern is too long (max {} characters)"
+                            .format(MAX_REGEXP_LENGTH))
+        return
+    parsed = _parse_regexp(pattern)
+    _check_parsed(parsed)
+    if _count_repeats(parsed) > MAX_REGEXP_REPEATS:
+        raise BadRegexp("Search pattern is too complex (max {} repeats)"
+                        .format(MAX_REGEXP_REPEATS))
+
+
+def _search_in_pieces(search, window, looks_ahead):
+    """Search long texts in overlapping pieces, so that no single
+    search takes too long, and the time limit is checked in between.
+    Any match up to half a window long is found."""
+    step = window // 2
+
+    def matches(value):
+        start = 0
+        while start + window < len(value):
+            end = start + window
+            match = search(value, start, end)
+            # the end of the piece may look like the end of the text
+            if match and not (looks_ahead and match.end() == end):
+                return True
+            check_time_limit()
+            start += step
+        return search(value, start) is not None
+
+    return matches
+
+
+@lru_cache(maxsize=256)
+def compile_regexp(pattern, case_sensitive=False):
+    """Return a function that checks if a string matches the pattern.
+    Patterns without any special characters are just matched as
+    substrings, which is a lot faster.
+
+    In the worst case, a search takes time proportional to the length
+    of the text to the power of the number of repeats plus one. So
+    long texts are searched in pieces, sized so that searching each
+    piece is reasonably quick. This means that in long texts, a match
+    longer than half a piece (e.g. over about 850 characters with
+    one repeat, or 70 with two) may be missed."""
+    if not REGEXP_CHARACTERS.intersection(pattern):
+        if case_sensitive:
+            return lambda value: pattern in value
+        lowered = pattern.lower()
+        return lambda value: lowered in value.lower()
+    check_regexp(pattern)
+    parsed = _parse_regexp(pattern)
+    flags = 0 if case_sensitive else re.IGNORECASE
+    search = re.compile(pattern, flags).search
+    window = int(REGEXP_WINDOW_COST ** (1 / (_count_repeats(parsed) + 1)))
+    return _search_in_pieces(search, window, _looks_ahead(parsed))
+
+
+@db.func("regexp")
+def regexp(pattern, value, case_sensitive=False):
+    """Replaces the built-in REGEXP, which compiles the pattern once
+    per row. Case insensitive unless a third argument is given."""
+    if pattern is None or value is None:
+        return None
+    return compile_regexp(pattern, bool(case_sensitive))(value)
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+# How many sqlite VM instructions to run between checks of the time limit
+PROGRESS_INTERVAL = 1000
+
+
+# the time limit of the current search, if any, see time_limit
+_deadline = local()
+
+
+def check_time_limit():
+    """Raise SearchTimeout if the current search has gone on for too
+    long. For Python functions called by queries, which sqlite can't
+    interrupt (see time_limit)."""
+    deadline = getattr(_deadline, "value", None)
+    if deadline is not None and monotonic() > deadline:
+        raise SearchTimeout()
+
+
+@contextmanager
+def time_limit(seconds):
+    """Interrupt any database query that goes on for longer than
+    the given number of seconds, raising SearchTimeout instead.
+    Note that a call to a Python function (e.g. REGEXP) can't be
+    interrupted by sqlite, only the query as a whole. That's why
+    some regexps are not allowed (see check_regexp), and long texts
+    are searched in pieces, checking the time in between."""
+    if not seconds:
+        yield
+        return
+    conn = db.get_conn()
+    deadline = monotonic() + seconds
+    previous = getattr(_deadline, "value", None)
+    _deadline.value = deadline
+    conn.set_progress_handler(lambda: monotonic() > deadline,
+                              PROGRESS_INTERVAL)
+    try:
+        yield
+    except OperationalError as e:
+        # if a function gave up, sqlite only tells us that it failed
+        if "interrupted" in str(e) or monotonic() > deadline:
+            raise SearchTimeout(seconds)
+        raise
+    finally:
+        conn.set_progress_handler(None, PROGRESS_INTERVAL)
+        _deadline.value = previous
+
+
+# A connection of our own, only used to check if the database has
+# changed. PRAGMA data_version on it changes whenever some other
+# connection commits, in this process or another, so it can be shared
+# by all threads (or greenlets), whatever connection they use.
+_watcher = dict(conn=None, version=None)
+_watcher_lock = Lock()
+
+
+def database_changed():
+    """Check if the database has been written to since the last time
+    anyone in this process checked, e.g. by another process, or some
+    part of this one that doesn't send signals. This is cheap enough
+    to do for every request."""
+    with _watcher_lock:
+        if _watcher["conn"] is None:
+            _watcher["conn"] = sqlite3.connect(db.database,
+                                               check_same_thread=False)
+        version = _watcher["conn"].execute("PRAGMA data_version").fetchone()[0]
+        changed = (_watcher["version"] is not None and
+                   version != _watcher["version"])
+        _watcher["version"] = version
+    return changed
+
+
+def forget_database_changes():
+    "Start over, e.g. when the database is replaced"
+    with _watcher_lock:
+        if _watcher["conn"] is not None:
+            _watcher["conn"].close()
+        _watcher["conn"] = _watcher["version"] = None
+
+
 class CustomJSONField(JSONField):
 
     def db_value(self, value):
@@ -29,17 +428,82 @@ def setup_database(db_name, close=True):
     # TODO: support further configuration options, see FlaskDB
     db_dependencies_installed()
     db.init(db_name)
+    ChangeSequence.create_table(fail_silently=True)
     Logbook.create_table(fail_silently=True)
+    new_columns = add_missing_columns(Logbook)
+    if "revision_n" in new_columns:
+        Logbook.count_revisions()
+    if not LogbookClosure.table_exists():
+        LogbookClosure.create_table()
+        LogbookClosure.rebuild()
     LogbookChange.create_table(fail_silently=True)
     Entry.create_table(fail_silently=True)
+    new_columns += add_missing_columns(Entry)
+    if "revision_n" in new_columns:
+        Entry.count_revisions()
+    ChangeSequence.setup(renumber="change_seq" in new_columns)
     EntryChange.create_table(fail_silently=True)
+    EntrySnapshot.create_table(fail_silently=True)
     EntryLock.create_table(fail_silently=True)
     Attachment.create_table(fail_silently=True)
+    QueuedAction.create_table(fail_silently=True)
+    if not EntrySearch.table_exists():
+        # first time; build the full-text index from existing entries
+        EntrySearch.create_table(tokenize="unicode61")
+        EntrySearch.index_entries(Entry.select())
+    EntryTrigram.enabled = EntryTrigram.table_exists()
+    if not EntryTrigram.enabled:
+        try:
+            with db.atomic():
+                EntryTrigram.create_table(tokenize="trigram")
+                EntryTrigram.index_entries(Entry.select())
+            EntryTrigram.enabled = True
+        except OperationalError as e:
+            logging.warning("Could not create the trigram index: %s", e)
+    if not SearchWord.table_exists():
+        # always kept up to date, in case the trigram index goes away,
+        # e.g. if the database is moved to an older sqlite version
+        SearchWord.create_table()
+        SearchWord.index_entries(Entry.select())
+    if not EntryAttribute.table_exists():
+        EntryAttribute.create_table()
+        EntryAttribute.index_entries(Entry.select())
+    # the summary needs to be recalculated if the authors are new
+    update_summary = False
+    if not EntryAuthor.table_exists():
+        EntryAuthor.create_table()
+        EntryAuthor.index_entries(Entry.select())
+        update_summary = True
+    if not EntrySummary.table_exists():
+        EntrySummary.create_table()
+        update_summary = True
+    if update_summary:
+        EntrySummary.update_entries()
+    # cached diffs may belong to some other database
+    revision_diff.cache_clear()
+    forget_database_changes()
     # print("\n".join(line[0] for line in db.execute_sql("pragma compile_options;")))
     if close:
         db.close()  # important
 
 
+def add_missing_columns(model):
+    """Add any columns that have been added to the model since the
+    table was created. They must be nullable, or have a default.
+    Returns the names of the added fields."""
+    table = model._meta.db_table
+    columns = set(column.name for column in db.get_columns(table))
+    migrator = SqliteMigrator(db)
+    operations = [migrator.add_column(table, field.db_column, field)
+                  for field in model._meta.sorted_fields
+                  if field.db_column not in columns]
+    if operations:
+        logging.info("Adding missing columns to table %s", table)
+        migrate(*operations)
+    return [field.name for field in model._meta.sorted_fields
+            if field.db_column not in columns]
+
+
 def db_dependencies_installed(type='SQLite'):
     "Check that the sqlite library has the necessary features."
     if type == 'SQLite':
@@ -80,6 +544,112 @@ class UTCDateTimeField(DateTimeField):
         return super().db_value(value.replace(tzinfo=None))
 
 
+class ChangeSequence(Model):
+
+    """
+    A counter that is increased every time a logbook or entry is
+    saved, and stored on the row as its change_seq. This way, anyone
+    can keep track of the last number they have seen and ask for just
+    the things that changed after that, without going through
+    everything. Since sqlite only allows one writer at a time, the
+    numbers are handed out in the same order as the changes become
+    visible.
+    """
+
+    class Meta:
+        database = db
+
+    value = IntegerField(default=0)
+
+    @classmethod
+    def setup(cls, renumber=False):
+        """Make sure the counter exists. If renumber is set, the
+        existing logbooks and entries are given unique numbers,
+        e.g. when the column has just been added."""
+        with db.atomic():
+            if renumber:
+                n_logbooks = Logbook.select(fn.MAX(Logbook.id)).scalar() or 0
+                Logbook.update(change_seq=Logbook.id).execute()
+                Entry.update(change_seq=Entry.id + n_logbooks).execute()
+                cls.delete().execute()
+            if not cls.select().exists():
+                value = max(Logbook.select(fn.MAX(Logbook.change_seq))
+                            .scalar() or 0,
+                            Entry.select(fn.MAX(Entry.change_seq))
+                            .scalar() or 0)
+                cls.create(value=value)
+
+    @classmethod
+    def next(cls):
+        """Get the next number in the sequence. Should be called in
+        the same transaction as the change is saved in."""
+        cls.update(value=cls.value + 1).execute()
+        return cls.current()
+
+    @classmethod
+    def current(cls):
+        "The latest number handed out"
+        return cls.select(cls.value).scalar()
+
+    @classmethod
+    def wait(cls, since, timeout, interval=0.5):
+        """Block until the sequence has gone past the given number, or
+        the timeout runs out. Returns the current number. We just ask
+        the database over and over, since the change may well be made
+        by some other process; it's cheap enough."""
+        deadline = monotonic() + timeout
+        while True:
+            current = cls.current()
+            remaining = deadline - monotonic()
+            if current > since or remaining <= 0:
+                return current
+            sleep(min(interval, remaining))
+
+    @classmethod
+    def get_changed(cls, since=0, logbook=None, limit=None):
+        """Find logbooks and entries that have changed after the given
+        number, optionally only in a logbook (and its descendants).
+        Returns (logbooks, entries, cursor), where the cursor is the
+        number to ask from next time."""
+        logbooks = Logbook.select(Logbook.id, Logbook.parent,
+                                  Logbook.change_seq, Logbook.revision_n,
+                                  Logbook.created_at, Logbook.last_changed_at,
+                                  Logbook.archived)
+        entries = Entry.select(Entry.id, Entry.logbook, Entry.follows,
+                               Entry.change_seq, Entry.revision_n,
+                               Entry.created_at, Entry.last_changed_at,
+                               Entry.archived)
+        if logbook is not None:
+            descendants = (LogbookClosure.select(LogbookClosure.descendant)
+                           .where(LogbookClosure.ancestor == logbook))
+            logbooks = logbooks.where(Logbook.id << descendants)
+            entries = entries.where(Entry.logbook << descendants)
+        logbooks = logbooks.where(Logbook.change_seq > since)
+        entries = entries.where(Entry.change_seq > since)
+        # reading in one transaction, so that nothing can get in
+        # between the rows and the cursor
+        with db.atomic():
+            cursor = cls.current()
+            if limit is None:
+                return (list(logbooks.order_by(Logbook.change_seq)),
+                        list(entries.order_by(Entry.change_seq)),
+                        cursor)
+            logbooks = list(logbooks.order_by(Logbook.change_seq)
+                            .limit(limit))
+            entries = list(entries.order_by(Entry.change_seq).limit(limit))
+        changed = sorted(logbooks + entries, key=lambda row: row.change_seq)
+        if len(changed) > limit:
+            # there is more; continue after the last one we return
+            changed = changed[:limit]
+            logbooks = [row for row in changed if isinstance(row, Logbook)]
+            entries = [row for row in changed if isinstance(row, Entry)]
+            cursor = changed[-1].change_seq
+        elif len(logbooks) == limit or len(entries) == limit:
+            # there may be more of one of them
+            cursor = changed[-1].change_seq
+        return logbooks, entries, cursor
+
+
 class Logbook(Model):
 
     """
@@ -99,14 +669,42 @@ class Logbook(Model):
     attributes = JSONField(default=[])
     metadata = JSONField(default={})
     archived = BooleanField(default=False)
+    # the number of changes made, kept up to date by make_change
+    revision_n = IntegerField(default=0)
+    # when it was last saved, see ChangeSequence
+    change_seq = IntegerField(default=0, index=True)
+
+    # set by make_change, to check that nobody else changed it since
+    _previous_revision_n = None
 
     def __str__(self):
         return "[{}] {}".format(self.id, self.name)
 
+    class Conflict(Exception):
+        pass
+
     def get_entries(self, **kwargs):
         "Convenient way to query for entries in this logbook"
         return Entry.search(logbook=self, **kwargs)
 
+    @classmethod
+    def get_tree(cls):
+        """Load all logbooks with one query, and connect them to their
+        parents and children. Returns the top level logbooks."""
+        logbooks = list(cls.select().order_by(cls.id))
+        by_id = {logbook.id: logbook for logbook in logbooks}
+        for logbook in logbooks:
+            logbook.children = []
+        top_level = []
+        for logbook in logbooks:
+            if logbook.parent_id is None:
+                top_level.append(logbook)
+            else:
+                parent = by_id[logbook.parent_id]
+                logbook.parent = parent
+                parent.children.append(logbook)
+        return top_level
+
     @property
     def ancestors(self):
         "The list of parent, grandparent, ..."
@@ -125,37 +723,44 @@ class Logbook(Model):
     @property
     def ancestors(self):
         "Return parent, grandparent, ..."
-        query = "\n".join([
-            "WITH RECURSIVE child(id,parent_id) AS (",
-            "    SELECT id, parent_id from logbook WHERE id = ?",
-            "    UNION ALL",
-            "    SELECT logbook.id, logbook.parent_id FROM logbook,child",
-            "    WHERE child.parent_id=logbook.id",
-            ")",
-            "SELECT child_logbook.*",
-            "FROM child",
-            "JOIN logbook as child_logbook ON child_logbook.id = child.id",
-            "WHERE child_logbook.id != ?"
-        ])
-        return self.raw(query, self.id, self.id)
+        return (Logbook.select()
+                .join(LogbookClosure,
+                      on=(LogbookClosure.ancestor == Logbook.id))
+                .where((LogbookClosure.descendant == self.id) &
+                       (LogbookClosure.depth > 0))
+                .order_by(LogbookClosure.depth))
 
     @property
     def descendants(self):
         "Return all children, grandchildren, etc of the logbook"
-        query = "\n".join([
-            "WITH RECURSIVE parent(id,parent_id) AS (",
-            "    values(?, NULL)",
-            "    UNION ALL",
-            "    SELECT logbook.id, logbook.parent_id FROM logbook,parent",
-            "    WHERE logbook.parent_id=parent.id",
-            ")",
-            "SELECT parent_logbook.*",
-            "FROM parent",
-            "JOIN logbook as parent_logbook ON parent_logbook.id = parent.id",
-            "GROUP BY parent.id",
-            "HAVING parent_logbook.id != ?"
-        ])
-        return self.raw(query, self.id, self.id)
+        return (Logbook.select()
+                .join(LogbookClosure,
+                      on=(LogbookClosure.descendant == Logbook.id))
+                .where((LogbookClosure.ancestor == self.id) &
+                       (LogbookClosure.depth > 0))
+                .order_by(LogbookClosure.depth, Logbook.id))
+
+    def save(self, *args, **kwargs):
+        with db.atomic():
+            is_new = self.id is None
+            # make_change sets the parent even if it's the same, so
+            # check that it's really different before moving anything
+            moved = (not is_new and "parent" in self._dirty and
+                     self.parent_id != (Logbook.select(Logbook.parent)
+                                        .where(Logbook.id == self.id)
+                                        .scalar()))
+            self.change_seq = ChangeSequence.next()
+            result = super().save(*args, **kwargs)
+            if not result and self._previous_revision_n is not None:
+                raise Logbook.Conflict(
+                    "Logbook {} has been changed by someone else!"
+                    .format(self.id))
+            self._previous_revision_n = None
+            if is_new:
+                LogbookClosure.add_logbook(self)
+            elif moved:
+                LogbookClosure.move_logbook(self)
+        return result
 
     def make_change(self, **values):
         "Change the logbook, storing the old values as a revision"
@@ -168,11 +773,44 @@ class Logbook(Model):
         for attr, value in values.items():
             setattr(self, attr, value)
         self.last_changed_at = change.timestamp
+        if self._previous_revision_n is None:
+            self._previous_revision_n = self.revision_n
+        self.revision_n += 1
         return change
 
-    @property
-    def revision_n(self):
-        return len(self.changes)
+    @classmethod
+    def count_revisions(cls):
+        "Set the revision counters from the number of stored changes"
+        n_changes = (LogbookChange.select(fn.COUNT(LogbookChange.id))
+                     .where(LogbookChange.logbook == cls.id))
+        cls.update(revision_n=n_changes).execute()
+
+    def _pk_expr(self):
+        # Used by peewee to select the row to update on save. If there
+        # is a change, the row must not have been changed by anyone
+        # else since we loaded it, or nothing gets updated.
+        expr = super()._pk_expr()
+        if self._previous_revision_n is not None:
+            expr &= (Logbook.revision_n == self._previous_revision_n)
+        return expr
+
+    # the fields that are tracked by changes
+    REVISION_FIELDS = ("name", "description", "template", "attributes",
+                       "archived", "parent_id")
+
+    def get_changes(self):
+        """Get all changes to the logbook, oldest first, with the
+        values before and after each change already filled in."""
+        changes = list(self.changes.order_by(LogbookChange.id))
+        values = {attr: getattr(self, attr) for attr in self.REVISION_FIELDS}
+        # go backwards from the current state, undoing each change
+        for change in reversed(changes):
+            change.new_values = dict(values)
+            values.update((attr, value)
+                          for attr, value in change.changed.items()
+                          if attr in values)
+            change.old_values = dict(values)
+        return changes
 
     def get_revision(self, version):
         if version == self.revision_n:
@@ -270,6 +908,95 @@ class Logbook(Model):
         return result
 
 
+class LogbookClosure(Model):
+
+    """
+    Every (ancestor, descendant) pair of logbooks, with the number of
+    levels between them. Each logbook is also its own ancestor, at
+    depth 0. This makes it possible to find all descendants or
+    ancestors of a logbook without recursive queries. It's updated
+    whenever a logbook is created or moved.
+    """
+
+    class Meta:
+        database = db
+        primary_key = CompositeKey("ancestor", "descendant")
+        indexes = (
+            (("descendant", "depth"), False),
+        )
+
+    ancestor = ForeignKeyField(Logbook, related_name="descendant_links")
+    descendant = ForeignKeyField(Logbook, related_name="ancestor_links")
+    depth = IntegerField()
+
+    @classmethod
+    def add_logbook(cls, logbook):
+        "Insert a new logbook under its parent"
+        db.execute_sql(
+            "INSERT INTO logbookclosure (ancestor_id, descendant_id, depth)"
+            " SELECT ancestor_id, ?, depth + 1 FROM logbookclosure"
+            " WHERE descendant_id = ?"
+            " UNION ALL SELECT ?, ?, 0",
+            (logbook.id, logbook.parent_id, logbook.id, logbook.id))
+
+    @classmethod
+    def move_logbook(cls, logbook):
+        "Move a logbook, and its whole subtree, to its new parent"
+        subtree = ("SELECT descendant_id FROM logbookclosure"
+                   " WHERE ancestor_id = ?")
+        # disconnect the subtree from its old ancestors...
+        db.execute_sql(
+            "DELETE FROM logbookclosure"
+            " WHERE descendant_id IN ({subtree})"
+            " AND ancestor_id NOT IN ({subtree})".format(subtree=subtree),
+            (logbook.id, logbook.id))
+        # ...and connect it to the new ones
+        db.execute_sql(
+            "INSERT INTO logbookclosure (ancestor_id, descendant_id, depth)"
+            " SELECT above.ancestor_id, below.descendant_id,"
+            "   above.depth + below.depth + 1"
+            " FROM logbookclosure AS above, logbookclosure AS below"
+            " WHERE above.descendant_id = ? AND below.ancestor_id = ?",
+            (logbook.parent_id, logbook.id))
+
+    # All the pairs, calculated from the logbook parents
+    RECURSIVE_QUERY = """
+    WITH RECURSIVE closure(ancestor_id, descendant_id, depth) AS (
+        SELECT id, id, 0 FROM logbook
+        UNION ALL
+        SELECT closure.ancestor_id, logbook.id, closure.depth + 1
+        FROM logbook JOIN closure ON logbook.parent_id = closure.descendant_id
+    )
+    """
+
+    @classmethod
+    def check(cls):
+        """Compare the table to the actual logbook hierarchy. Returns a
+        list of (ancestor_id, descendant_id, depth) rows that are
+        missing, and a list of rows that should not be there."""
+        missing = db.execute_sql(
+            cls.RECURSIVE_QUERY +
+            " SELECT * FROM closure EXCEPT"
+            " SELECT ancestor_id, descendant_id, depth FROM logbookclosure"
+        ).fetchall()
+        extra = db.execute_sql(
+            cls.RECURSIVE_QUERY +
+            " SELECT ancestor_id, descendant_id, depth FROM logbookclosure"
+            " EXCEPT SELECT * FROM closure"
+        ).fetchall()
+        return missing, extra
+
+    @classmethod
+    def rebuild(cls):
+        "Recreate the whole table from the logbook parents"
+        with db.atomic():
+            cls.delete().execute()
+            db.execute_sql(
+                cls.RECURSIVE_QUERY +
+                " INSERT INTO logbookclosure (ancestor_id, descendant_id, depth)"
+                " SELECT * FROM closure")
+
+
 class LogbookChange(Model):
 
     class Meta:
@@ -284,11 +1011,16 @@ class LogbookChange(Model):
     change_comment = TextField(null=True)
     change_ip = CharField(null=True)
 
+    # filled in by Logbook.get_changes()
+    old_values = new_values = None
+
     def get_old_value(self, attr):
 
         """Get the value of the attribute at the time of this revision.
         That is, *before* the change happened."""
 
+        if self.old_values is not None and attr in self.old_values:
+            return self.old_values[attr]
         # First check if the attribute was changed in this revision,
         # in that case we return that.
         if attr in self.changed:
@@ -314,6 +1046,8 @@ class LogbookChange(Model):
         """Get the value of the attribute at the time of this revision.
         That is, *before* the change happened."""
 
+        if self.new_values is not None and attr in self.new_values:
+            return self.new_values[attr]
         # check for the next revision where this attribute
         # changed; the value from there must be the current value
         # at this revision.
@@ -342,7 +1076,10 @@ class LogbookRevision:
         if attr == "id":
             return self.change.logbook.id
         if attr == "revision_n":
-            return list(self.change.logbook.changes).index(self.change)
+            return (LogbookChange.select()
+                    .where((LogbookChange.logbook == self.change.logbook) &
+                           (LogbookChange.id < self.change.id))
+                    .count())
 
         if attr in ("name", "description", "template", "attributes",
                     "archived", "parent_id"):
@@ -351,14 +1088,6 @@ class LogbookRevision:
         return getattr(self.change.logbook, attr)
 
 
-# DeferredEntry = DeferredRelation()
-
-
-# class EntrySearch(FTS5Model):
-#     entry = ForeignKeyField(DeferredEntry)
-#     content = SearchField()
-
-
 class MLStripper(HTMLParser):
 
     def __init__(self):
@@ -395,6 +1124,129 @@ def escape_string(s):
     return s.replace("'", "''")
 
 
+# Markers around matched words in search result snippets. They are
+# control characters so that they can't clash with the actual text.
+SNIPPET_MATCH_START = "\x02"
+SNIPPET_MATCH_END = "\x03"
+
+
+def fulltext_query(column, text):
+    """Turn a search filter into a full-text query on the given column,
+    matching each word as a prefix. Returns None if the filter can't be
+    expressed that way, e.g. if it's a regexp."""
+    if REGEXP_CHARACTERS.intersection(text):
+        return None
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    return "{}: ({})".format(
+        column, " ".join('"{}"*'.format(word) for word in words))
+
+
+def _required_literals(parsed, make_term):
+    """Build a full-text query for the literal strings that anything
+    matching the parsed regexp must contain, using make_term to turn
+    each string into a query (or None if it can't be used). Returns
+    None if there are no usable strings."""
+    terms = []
+    run = []
+
+    def flush():
+        term = run and make_term("".join(run))
+        if term:
+            terms.append(term)
+        del run[:]
+
+    for op, arg in parsed:
+        if op == sre_constants.LITERAL:
+            run.append(chr(arg))
+            continue
+        flush()
+        term = None
+        if op == sre_constants.SUBPATTERN:
+            # the group contents are the last item, regardless of version
+            term = _required_literals(arg[-1], make_term)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            min_repeat, _, item = arg
+            if min_repeat > 0:
+                term = _required_literals(item, make_term)
+        elif op == sre_constants.BRANCH:
+            alternatives = [_required_literals(item, make_term)
+                            for item in arg[1]]
+            if all(alternatives):
+                term = "({})".format(" OR ".join(alternatives))
+        if term:
+            terms.append(term)
+    flush()
+    if terms:
+        return " AND ".join(terms)
+
+
+def _trigram_term(literal):
+    # shorter strings can't be found using trigrams
+    if len(literal) >= 3:
+        return '"{}"'.format(literal.replace('"', '""'))
+
+
+def trigram_query(column, pattern):
+    """Turn a search regexp into a query on the trigram index, finding
+    the entries that may match. Returns None if that's not possible,
+    and the regexp has to be checked against every entry."""
+    try:
+        literals = _required_literals(sre_parse.parse(pattern),
+                                      _trigram_term)
+    except (sre_constants.error, OverflowError, RecursionError):
+        return None
+    if literals:
+        return "{}: ({})".format(column, literals)
+
+
+# what the full-text index considers a word (unicode61 tokenizer)
+WORD = re.compile(r"[^\W_]+")
+
+
+def _word_terms(literal):
+    """Full-text terms for the words that any text containing the
+    literal string must contain. A word with something else before and
+    after it in the literal is a whole word in the text too, and one
+    with something before it is the start of a word. Otherwise it may
+    be any part of a word, and we have to look up which words those
+    are (see SearchWord)."""
+    terms = []
+    for match in WORD.finditer(literal):
+        word = match.group().lower()
+        whole_start = match.start() > 0
+        whole_end = match.end() < len(literal)
+        if whole_start and whole_end:
+            terms.append('"{}"'.format(word))
+        elif whole_start:
+            if len(word) >= 2:
+                terms.append('"{}"*'.format(word))
+        elif len(word) >= 3:
+            words = SearchWord.containing(word, at_end=whole_end)
+            if words is None:
+                continue  # too many to be useful
+            # if there are none, this matches nothing, as it should
+            terms.append("({})".format(
+                " OR ".join('"{}"'.format(w) for w in words or [word])))
+    if terms:
+        return " AND ".join(terms)
+
+
+def word_query(column, pattern):
+    """Turn a search regexp (or plain string) into a query on the
+    full-text index, finding the entries that may match. Returns None
+    if that's not possible, and the regexp has to be checked against
+    every entry. Used when there's no trigram index."""
+    try:
+        literals = _required_literals(sre_parse.parse(pattern),
+                                      _word_terms)
+    except (sre_constants.error, OverflowError, RecursionError):
+        return None
+    if literals:
+        return "{}: ({})".format(column, literals)
+
+
 class Entry(Model):
 
     class Meta:
@@ -418,6 +1270,17 @@ class Entry(Model):
     last_changed_at = UTCDateTimeField(null=True)
     follows = ForeignKeyField("self", null=True, related_name="followups")
     archived = BooleanField(default=False)
+    # plain text version of the content, and the start of it, which
+    # are updated on save so we don't need to parse HTML when listing
+    text = TextField(null=True)
+    preview = CharField(null=True)
+    # the number of changes made, kept up to date by make_change
+    revision_n = IntegerField(default=0)
+    # when it was last saved, see ChangeSequence
+    change_seq = IntegerField(default=0, index=True)
+
+    # set by make_change, to check that nobody else changed it since
+    _previous_revision_n = None
 
     def __str__(self):
         return "[{}] {}".format(self.id, self.title)
@@ -425,23 +1288,85 @@ class Entry(Model):
     class Locked(Exception):
         pass
 
+    class Conflict(Exception):
+        pass
+
+    @classmethod
+    def prefetch(cls, entries, logbooks=True, attachments=True, locks=False):
+        """Load the logbooks, attachments and/or active locks of a list
+        of entries, with one query each instead of one per entry."""
+        if not entries:
+            return entries
+        by_id = {entry.id: entry for entry in entries}
+        if logbooks:
+            logbook_ids = list({entry.logbook_id for entry in entries})
+            logbooks = {logbook.id: logbook
+                        for logbook in (Logbook.select()
+                                        .where(Logbook.id << logbook_ids))}
+            for entry in entries:
+                entry.logbook = logbooks[entry.logbook_id]
+        if attachments:
+            for entry in entries:
+                entry.attachments = []
+            for attachment in (Attachment.select()
+                               .where(Attachment.entry << list(by_id))):
+                by_id[attachment.entry_id].attachments.append(attachment)
+        if locks:
+            for entry in entries:
+                entry._lock = None
+            for lock in (EntryLock.select()
+                         .where((EntryLock.entry << list(by_id)) &
+                                EntryLock.active())):
+                by_id[lock.entry_id]._lock = lock
+        return entries
+
     @property
     def _thread(self):
-        entries = []
-        if self.follows:
-            entry = Entry.get(Entry.id == self.follows_id)
-            while True:
-                entries.append(entry)
-                if entry.follows_id:
-                    try:
-                        entry = Entry.get(Entry.id == entry.follows_id)
-                    except DoesNotExist:
-                        break
-                else:
-                    break
-        if entries:
-            return entries[-1]
-        return self
+        return Entry.get_thread(self.id)
+
+    # Finds the top of the thread an entry belongs to, and then all
+    # the followups below it (or below the entry itself).
+    THREAD_QUERY = """
+    WITH RECURSIVE
+    parents(id, follows_id) AS (
+        SELECT id, follows_id FROM entry WHERE id = ?
+        UNION
+        SELECT entry.id, entry.follows_id
+        FROM entry JOIN parents ON entry.id = parents.follows_id
+    ),
+    thread(id) AS (
+        SELECT id FROM parents WHERE {top}
+        UNION ALL
+        SELECT entry.id FROM entry JOIN thread ON entry.follows_id = thread.id
+    )
+    SELECT entry.* FROM entry WHERE entry.id IN thread ORDER BY entry.id
+    """
+
+    @classmethod
+    def get_thread(cls, entry_id, whole=True):
+        """Load an entry with all its followups, recursively, and their
+        attachments and locks, using a fixed number of queries. If
+        whole is True, start from the top of the entry's thread."""
+        if whole:
+            top = ("follows_id IS NULL OR"
+                   " follows_id NOT IN (SELECT id FROM parents)")
+        else:
+            top = "id = ?"
+        params = (entry_id,) if whole else (entry_id, entry_id)
+        entries = list(cls.raw(cls.THREAD_QUERY.format(top=top), *params))
+        if not entries:
+            raise cls.DoesNotExist
+        cls.prefetch(entries, logbooks=False, locks=True)
+        by_id = {entry.id: entry for entry in entries}
+        for entry in entries:
+            entry.followups = []
+        for entry in entries:
+            if entry.follows_id in by_id:
+                by_id[entry.follows_id].followups.append(entry)
+        if whole:
+            return next(entry for entry in entries
+                        if entry.follows_id not in by_id)
+        return by_id[entry_id]
 
     @property
     def next(self):
@@ -503,19 +1428,60 @@ class Entry(Model):
             else:
                 # default to using the generated "now" timestamp
                 self.last_changed_at = change.timestamp
+        if self._previous_revision_n is None:
+            self._previous_revision_n = self.revision_n
+        self.revision_n += 1
         return change
 
-    @property
-    def revision_n(self):
-        return len(self.changes)
+    @classmethod
+    def count_revisions(cls):
+        "Set the revision counters from the number of stored changes"
+        n_changes = (EntryChange.select(fn.COUNT(EntryChange.id))
+                     .where(EntryChange.entry == cls.id))
+        cls.update(revision_n=n_changes).execute()
+
+    def _pk_expr(self):
+        # See Logbook._pk_expr
+        expr = super()._pk_expr()
+        if self._previous_revision_n is not None:
+            expr &= (Entry.revision_n == self._previous_revision_n)
+        return expr
+
+    def get_changes(self):
+        """Get all changes to the entry, oldest first, with the
+        values before and after each change already filled in."""
+        changes = list(self.changes.order_by(EntryChange.id))
+        values = {attr: getattr(self, attr) for attr in EntrySnapshot.FIELDS}
+        # go backwards from the current state, undoing each change
+        for change in reversed(changes):
+            change.new_values = dict(values)
+            values.update((attr, value)
+                          for attr, value in change.changed.items()
+                          if attr in values)
+            if "content_patch" in change.changed:
+                values["content"] = apply_patch(
+                    values["content"], change.changed["content_patch"])
+            change.old_values = dict(values)
+        return changes
 
     def get_revision(self, version):
-        if version == self.revision_n:
+        revision_n = self.revision_n
+        if version == revision_n:
             return self
-        if 0 <= version < self.revision_n:
-            return EntryRevision(self.changes[version])
+        if 0 <= version < revision_n:
+            return EntryRevision.reconstruct(self, version, revision_n)
         raise(EntryChange.DoesNotExist)
 
+    def get_diff(self, from_version, to_version=None):
+        "Get a HTML diff between two revisions of the content"
+        revision_n = self.revision_n
+        if to_version is None:
+            to_version = revision_n
+        if not (0 <= from_version <= revision_n and
+                0 <= to_version <= revision_n):
+            raise(EntryChange.DoesNotExist)
+        return revision_diff(self.id, from_version, to_version)
+
     # def get_old_version(self, revision_id):
     #     revisions = (EntryChange.select()
     #                  .where(EntryChange.entry == self
@@ -530,9 +1496,70 @@ class Entry(Model):
     #             content = apply_patch(content, revision.content)
     #     return content
 
+    def save(self, *args, **kwargs):
+        self.update_text()
+        with db.atomic():
+            threads = {self.follows_id}
+            if self.id is not None and "follows" in self._dirty:
+                # the entry is moved, so the old thread also changes
+                threads.add(Entry.select(Entry.follows)
+                            .where(Entry.id == self.id).scalar())
+            self.change_seq = ChangeSequence.next()
+            result = super().save(*args, **kwargs)
+            if not result and self._previous_revision_n is not None:
+                raise Entry.Conflict(
+                    "Entry {} has been changed by someone else!"
+                    .format(self.id))
+            self._previous_revision_n = None
+            EntrySearch.index_entries([self])
+            if EntryTrigram.enabled:
+                EntryTrigram.index_entries([self])
+            SearchWord.index_entries([self])
+            EntryAttribute.index_entries([self])
+            EntryAuthor.index_entries([self])
+            # the followups' own summaries don't depend on this entry,
+            # only the summary of the thread(s) it's in
+            EntrySummary.update_entries(
+                [self.id] + [t for t in threads if t is not None])
+        return result
+
     @property
     def stripped_content(self):
-        return strip_tags(self.content)
+        if self.text is None:
+            return self.make_text()
+        return self.text
+
+    def make_text(self):
+        "Convert the content into plain text"
+        content = self.content or ""
+        if self.content_type.startswith("text/html"):
+            return strip_tags(content)
+        return content
+
+    def update_text(self):
+        self.text = self.make_text()
+        self.preview = self.text.strip()[:200].strip().replace("\n", " ")
+
+    @classmethod
+    def backfill_text(cls, batch_size=1000):
+        """Update the plain text of all entries that don't have it,
+        e.g. from before it was introduced. Returns the number of
+        entries updated."""
+        n = 0
+        while True:
+            with db.atomic():
+                entries = list(cls.select(cls.id, cls.content,
+                                          cls.content_type)
+                               .where(cls.text >> None)
+                               .limit(batch_size))
+                if not entries:
+                    return n
+                for entry in entries:
+                    entry.update_text()
+                    (cls.update(text=entry.text, preview=entry.preview)
+                     .where(cls.id == entry.id)
+                     .execute())
+            n += len(entries)
 
     def get_attachments(self, embedded=False):
         return self.attachments.filter((Attachment.embedded == embedded) &
@@ -548,8 +1575,7 @@ class Entry(Model):
         try to acquire it."""
         try:
             lock = EntryLock.get((EntryLock.entry_id == self.id) &
-                                 (EntryLock.expires_at > datetime.utcnow()) &
-                                 (EntryLock.cancelled_at == None))
+                                 EntryLock.active())
             if steal:
                 lock.cancel(ip)
                 return EntryLock.create(entry=self, owned_by_ip=ip)
@@ -562,6 +1588,9 @@ class Entry(Model):
 
     @property
     def lock(self):
+        # may have been loaded already, see get_thread
+        if hasattr(self, "_lock"):
+            return self._lock
         return self.get_lock()
 
     @classmethod
@@ -571,191 +1600,212 @@ class Entry(Model):
                attribute_filter=None, content_filter=None,
                title_filter=None, author_filter=None,
                attachment_filter=None, metadata_filter=None,
-               sort_by_timestamp=True):
-
-        # Note: this is all pretty messy. The reason we're building
-        # the query as a raw string is that peewee does not (currently)
-        # support recursive queries, which we need in order to search
-        # through nested logbooks. Cleanup needed!
+               sort_by_timestamp=True, ranked=False, after=None):
+
+        # Note: this is all pretty messy. The query is built as a raw
+        # string since it originally needed recursive queries, which
+        # peewee does not (currently) support. Cleanup needed!
+
+        # When ranking results, simple word searches in content and
+        # title are handled by the full-text index, which computes the
+        # rank. That matches whole words (by prefix), so it's only done
+        # when asked for; otherwise filters keep matching substrings,
+        # using REGEXP on the entries that an index says may match.
+        for pattern in [content_filter, title_filter,
+                        author_filter, attachment_filter]:
+            if pattern:
+                check_regexp(pattern)
+        fulltext_filters = []
+        content_regexp = title_regexp = None
+        if content_filter:
+            content_query = ranked and fulltext_query("content",
+                                                      content_filter)
+            if content_query:
+                fulltext_filters.append(content_query)
+            else:
+                content_regexp = content_filter
+        if title_filter:
+            title_query = ranked and fulltext_query("title", title_filter)
+            if title_query:
+                fulltext_filters.append(title_query)
+            else:
+                title_regexp = title_filter
 
-        if author_filter:
-            # extract the author names as a separate table, so that
-            # they can be searched
-            # TODO: maybe also take login?
-            authors = ", json_each(entry.authors) AS authors2"
+        ranked = ranked and bool(fulltext_filters)
+        # candidate entries found by the indexes, as (subquery, name)
+        candidates = []
+        variables = []
+        if ranked:
+            # Order by relevance, and get a snippet of text around the
+            # matches. Both are computed by the full-text index.
+            candidates.append((
+                "SELECT rowid,"
+                " bm25(entrysearch) AS rank,"
+                " snippet(entrysearch, -1, char(2), char(3), '...', 24)"
+                " AS snippet"
+                " FROM entrysearch WHERE entrysearch MATCH ?"
+                # the LIMIT keeps sqlite from flattening the
+                # subquery, since snippet() can't be used in
+                # an aggregate query.
+                " LIMIT -1", "fulltext"))
+            variables.append(" AND ".join(fulltext_filters))
+            ranking = ", fulltext.rank, fulltext.snippet"
         else:
-            authors = ""
-
-        if attribute_filter:
-            # need to extract the attribute values from JSON here, so that
-            # we can match on them later
-            attributes = ", {}".format(
-                ", ".join(
-                    "json_extract(entry.attributes, '$.{attr}') AS {attr_id}"
-                    .format(attr=escape_string(attr),
-                            attr_id="attr{}".format(i))
-                    for i, (attr, _) in enumerate(attribute_filter)))
+            ranking = ""
+
+        # The trigram index can find the entries containing the literal
+        # parts of the regexps (e.g. "abc" in "abc\d+"), so that only
+        # those have to be checked against the actual regexp. Without
+        # it, the full-text index can find them by the words in them,
+        # which isn't quite as selective.
+        if EntryTrigram.enabled:
+            index, index_query = EntryTrigram, trigram_query
         else:
-            attributes = ""
-
-        if metadata_filter:
-            # This works just like the attribute filter
-            metadata = ", {}".format(
-                ", ".join(
-                    "json_extract(entry.metadata, '$.{meta}') AS {meta_id}"
-                    .format(meta=escape_string(meta),
-                            meta_id="meta{}".format(i))
-                    for i, (meta, _) in enumerate(metadata_filter)))
+            index, index_query = EntrySearch, word_query
+        index_filters = []
+        for column, regexp in [("content", content_regexp),
+                               ("title", title_regexp)]:
+            index_filter = regexp and index_query(column, regexp)
+            if index_filter:
+                index_filters.append(index_filter)
+        if index_filters:
+            candidates.append((
+                "SELECT rowid FROM {table} WHERE {table} MATCH ?"
+                .format(table=index._meta.db_table), "candidates"))
+            variables.append(" AND ".join(index_filters))
+        elif content_regexp or title_regexp:
+            # the search is still subject to any time limit
+            logging.info("Can't use an index for the search %r, checking"
+                         " every entry", content_regexp or title_regexp)
+
+        if candidates:
+            # Start from the candidates, and only then look at the
+            # entries; a CROSS JOIN makes sqlite keep this order, so
+            # that any REGEXP is only run on the candidates, instead
+            # of on every entry.
+            (subquery, name), *rest = candidates
+            sources = "({}) AS {}".format(subquery, name)
+            for subquery, other in rest:
+                sources += (" CROSS JOIN ({}) AS {} ON {}.rowid = {}.rowid"
+                            .format(subquery, other, other, name))
+            sources += (" CROSS JOIN entry ON entry.id = {}.rowid"
+                        " CROSS JOIN entrysummary AS summary"
+                        " ON summary.entry_id = entry.id".format(name))
         else:
-            metadata = ""
+            sources = ("entrysummary AS summary"
+                       " JOIN entry ON entry.id = summary.entry_id")
+
+        # The per-thread numbers (followups, latest change, authors...)
+        # are kept up to date in the summary table, so that we don't
+        # need to aggregate over all the followups here.
+        query = """
+        SELECT entry.*{ranking},
+            summary.n_followups,
+            -- 'timestamp' is the latest modification time in the thread
+            summary.timestamp,
+            summary.followup_authors,
+            summary.n_attachments
+        FROM {sources}
+        JOIN logbook ON logbook.id = summary.logbook_id
+        WHERE NOT logbook.archived
+        """.format(ranking=ranking, sources=sources)
 
         if logbook:
             if child_logbooks:
-                # recursive query to find all entries in the given logbook
-                # or any of its descendants, to arbitrary depth, and also
-                # any high priority ("important") entries in ancestors
-                query = """
-                -- recursively add all 'descentant' logbooks (children, grandchilren, ...)
-                WITH RECURSIVE logbook1(id,parent_id) AS (
-                    values({logbook}, NULL)  -- parent logbook
-                    UNION ALL
-                    SELECT logbook.id, logbook.parent_id FROM logbook,logbook1
-                    WHERE logbook.parent_id=logbook1.id
-                ),
-                -- recursively add all 'ancestor' logbooks (parent, grandparent, ...)
-                logbook2(id,parent_id) AS (
-                    SELECT id, parent_id from logbook WHERE id = {logbook}
-                    UNION ALL
-                    SELECT logbook.id, logbook.parent_id FROM logbook,logbook2
-                    WHERE logbook2.parent_id=logbook.id
-                )
-                SELECT entry.*{attributes}{metadata},
-                    {attachment}
-                    -- 'thread' is the id of the main entry, ignoring followups
-                    coalesce(followup.follows_id, entry.id) AS thread,
-                    count(distinct(followup.id)) AS n_followups,
-                    -- 'timestamp' is the latest modification time in the thread
-                    max(datetime(coalesce(coalesce(followup.last_changed_at,followup.created_at),
-                        coalesce(entry.last_changed_at,entry.created_at)))) AS timestamp,
-                    -- collect authors from all followups
-                    json_group_array(json(ifnull(followup.authors, "[]"))) as followup_authors
-                FROM entry{authors}
-                JOIN logbook1
-                JOIN logbook2
-                JOIN logbook ON entry.logbook_id = logbook.id
-                {join_attachment}
-                LEFT JOIN entry AS followup ON entry.id == followup.follows_id
-                WHERE ((entry.logbook_id=logbook1.id)
-                       OR (entry.priority>100 AND entry.logbook_id=logbook2.id))
-                      AND NOT logbook.archived
-                """.format(attachment=("attachment.path as attachment_path,"
-                                       if attachment_filter else ""),
-                           authors=authors, logbook=logbook.id,
-                           attributes=attributes,
-                           metadata=metadata,
-                           join_attachment=("JOIN attachment ON attachment.entry_id == entry.id"
-                                            if attachment_filter else ""))
+                # find all entries in the given logbook or any of its
+                # descendants, to arbitrary depth, and also any high
+                # priority ("important") entries in ancestors
+                query += """
+                AND (summary.logbook_id IN (
+                         SELECT descendant_id FROM logbookclosure
+                         WHERE ancestor_id = {logbook})
+                     OR (summary.priority > 100
+                         AND summary.logbook_id IN (
+                             SELECT ancestor_id FROM logbookclosure
+                             WHERE descendant_id = {logbook})))
+                """.format(logbook=logbook.id)
             else:
                 # In this case we're not searching recursively
-                query = (
-                    """
-                    SELECT entry.*{attributes}{metadata},
-                      {attachment}
-                      coalesce(followup.follows_id, entry.id) AS thread,
-                      count(followup.id) AS n_followups,
-                      max(datetime(coalesce(coalesce(followup.last_changed_at,followup.created_at),
-                        coalesce(entry.last_changed_at,entry.created_at)))) AS timestamp,
-                      json_group_array(json(ifnull(followup.authors, "[]"))) as followup_authors
-                    FROM entry{authors}
-                    {join_attachment}
-                    JOIN logbook on logbook.id = entry.logbook_id
-                    LEFT JOIN entry AS followup ON entry.id == followup.follows_id
-                    WHERE entry.logbook_id = {logbook} AND NOT logbook.archived"""
-                    .format(attachment=("attachment.path as attachment_path,"
-                                       if attachment_filter else ""),
-                            authors=authors,
-                            attributes=attributes,
-                            metadata=metadata,
-                            logbook=logbook.id,
-                            join_attachment=("JOIN attachment ON attachment.entry_id == entry.id"
-                                             if attachment_filter else "")))
-
-        else:
-            # In this case we're searching all entries and don't need
-            # the recursive logbook filtering. This always includes
-            # child logbooks.
-            query = """
-            SELECT entry.*{attributes}{metadata},
-                {attachment}
-                coalesce(followup.follows_id, entry.id) AS thread,
-                count(followup.id) AS n_followups,
-                max(datetime(coalesce(coalesce(followup.last_changed_at,followup.created_at),
-                    coalesce(entry.last_changed_at,entry.created_at)))) AS timestamp,
-                json_group_array(json(ifnull(followup.authors, "[]"))) as followup_authors
-            FROM entry{authors}
-            {join_attachment}
-            JOIN logbook on logbook.id = entry.logbook_id
-            LEFT JOIN entry AS followup ON entry.id == followup.follows_id
-            WHERE NOT logbook.archived
-            """.format(attributes=attributes,
-                       metadata=metadata,
-                       attachment=("path as attachment_path,"
-                                   if attachment_filter else ""),
-                       authors=authors,
-                       join_attachment=(
-                           "JOIN attachment ON attachment.entry_id == entry.id"
-                           if attachment_filter else ""))
+                query += " AND summary.logbook_id = {}\n".format(logbook.id)
+        # Otherwise we're searching all entries and don't need the
+        # recursive logbook filtering. This always includes child logbooks.
 
         if not archived:
             query += " AND NOT entry.archived\n"
 
-        variables = []
-
-        # if not followups:
-        #     query += " AND entry.follows_id IS NULL"
-
         # further filters on the results, depending on search criteria
-        if content_filter:
-            # need to filter out null or REGEX will explode on them
-            query += " AND entry.content IS NOT NULL AND entry.content REGEXP ?\n"
-            variables.append(content_filter)
-        if title_filter:
+        if content_regexp:
+            # match the text, not the markup; it's NULL for entries
+            # that have not been converted yet
+            query += " AND coalesce(entry.text, entry.content) REGEXP ?\n"
+            variables.append(content_regexp)
+        if title_regexp:
             query += " AND entry.title IS NOT NULL AND entry.title REGEXP ?\n"
-            variables.append(title_filter)
+            variables.append(title_regexp)
         if author_filter:
-            query += " AND json_extract(authors2.value, '$.name') REGEXP ?\n"
+            query += " AND {}\n".format(EntryAuthor.CONDITION)
             variables.append(author_filter)
         if attachment_filter:
-            query += " AND attachment_path REGEXP ?\n"
+            query += (" AND EXISTS (SELECT 1 FROM attachment"
+                      " WHERE attachment.entry_id = entry.id"
+                      " AND attachment.path REGEXP ?)\n")
             variables.append(attachment_filter)
-        if attribute_filter:
-            for i, (attr, value) in enumerate(attribute_filter):
-                query += " AND attr{} LIKE ?".format(i)
-                variables.append('%{}%'.format(value))
-        if metadata_filter:
-            for i, (meta, value) in enumerate(metadata_filter):
-                query += " AND meta{} LIKE ?".format(i)
-                variables.append('{}'.format(value))
-
-        # Check if we're searching, in that case we want to show all entries.
-        if followups or any([title_filter, content_filter, author_filter,
-                             metadata_filter, attribute_filter, attachment_filter]):
-            query += " GROUP BY thread"
-        else:
-            # We're not searching. In this case we'll only show
-            query += " GROUP BY thread HAVING entry.follows_id IS NULL"
+        # attributes and metadata are looked up in the extracted
+        # key/value table
+        for namespace, filters in [("attributes", attribute_filter),
+                                   ("metadata", metadata_filter)]:
+            for name, value in filters or []:
+                condition, values = EntryAttribute.condition(
+                    namespace, name, value)
+                query += " AND {}\n".format(condition)
+                variables.extend(values)
 
         # sort newest first, taking into account the last edit if any
         # TODO: does this make sense? Should we only consider creation date?
-        order_by = sort_by_timestamp and "timestamp" or "entry.created_at"
-        query += " ORDER BY entry.priority DESC, {} DESC".format(order_by)
+        order_by = sort_by_timestamp and "summary.timestamp" or "entry.created_at"
+
+        # Check if we're searching, in that case we want to show all entries.
+        if not (followups or any([title_filter, content_filter, author_filter,
+                                  metadata_filter, attribute_filter,
+                                  attachment_filter])):
+            # We're not searching. In this case we'll only show
+            query += " AND entry.follows_id IS NULL\n"
+        if after:
+            # Keyset pagination; only take entries that come after the
+            # given (priority, timestamp, id) in the sort order. Unlike
+            # OFFSET, this does not need to step through earlier pages.
+            priority, sort_key, entry_id = after
+            query += (
+                " AND (summary.priority < ? OR (summary.priority = ? AND"
+                " ({order_by} < ? OR ({order_by} = ? AND summary.entry_id < ?))))\n"
+                .format(order_by=order_by))
+            variables.extend([priority, priority, sort_key, sort_key,
+                              entry_id])
+
+        if ranked:
+            # best matches first (lower bm25 score is better)
+            query += " ORDER BY fulltext.rank, {} DESC".format(order_by)
+        else:
+            query += (" ORDER BY summary.priority DESC, {} DESC,"
+                      " summary.entry_id DESC".format(order_by))
         if n:
             query += " LIMIT {}".format(n)
-            if offset:
+            if offset and not after:
                 query += " OFFSET {}".format(offset)
         logging.debug("query=%r, variables=%r" % (query, variables))
         return Entry.raw(query, *variables)
 
+    def get_sort_position(self, sort_by_timestamp=True):
+        """The position of a search result in the sort order, to be
+        used as 'after' argument to search() for getting the next page.
+        Note that 'timestamp' is only available on search results."""
+        if sort_by_timestamp:
+            sort_key = self.timestamp
+        else:
+            # the way sqlite stores datetimes
+            sort_key = self.created_at.isoformat(" ")
+        return [self.priority, sort_key, self.id]
+
     @classmethod
     def search_(cls, logbook=None, followups=False,
                 child_logbooks=False, parent_logbooks=True,
@@ -832,7 +1882,305 @@ class Entry(Model):
         return result
 
 
-#DeferredEntry.set_model(Entry)
+@lru_cache(maxsize=256)
+def revision_diff(entry_id, from_version, to_version):
+    """Diff the content of two revisions of an entry. Revisions never
+    change, so the result can be cached. Note that the versions must
+    be checked to exist, see Entry.get_diff."""
+    entry = Entry.get(Entry.id == entry_id)
+    old = entry.get_revision(from_version)
+    new = entry.get_revision(to_version)
+    old_content, new_content = old.content or "", new.content or ""
+    if entry.content_type.startswith("text/html"):
+        return htmldiff(old_content, new_content)
+    return TextMatcher(old_content, new_content).htmlDiff()
+
+
+class EntrySearch(FTS5Model):
+
+    """
+    Full-text index of entry titles and contents. The rowid is the id
+    of the entry. It's kept up to date whenever an entry is saved.
+    """
+
+    class Meta:
+        database = db
+
+    title = SearchField()
+    content = SearchField()
+
+    @classmethod
+    def index_entries(cls, entries):
+        "Add the given entries to the index, replacing any old versions"
+        for entry in entries:
+            cls.delete().where(cls.rowid == entry.id).execute()
+            cls.insert(rowid=entry.id, title=entry.title or "",
+                       content=entry.stripped_content).execute()
+
+
+class EntryTrigram(EntrySearch):
+
+    """
+    Index of every three character sequence in entry titles and
+    contents. It's used to narrow down the entries that may match a
+    substring or regexp search, before checking the actual regexp.
+    The trigram tokenizer needs sqlite 3.34 or later; without it,
+    searches work but are slower.
+    """
+
+    # set up in setup_database(), if supported
+    enabled = False
+
+
+class SearchWord(Model):
+
+    """
+    Every different word in entry titles and contents. The full-text
+    index can only find words by how they start, so to find the words
+    that contain some part (e.g. "beam" in "subbeam") we look them up
+    here. Words are never removed, so some may not be used anymore,
+    which does no harm.
+    """
+
+    class Meta:
+        database = db
+
+    word = CharField(primary_key=True)
+
+    # Looking for more words than this makes for a slow query, and
+    # such a common part is not much use for searching anyway.
+    MAX_MATCHES = 100
+
+    @classmethod
+    def index_entries(cls, entries, batch_size=500):
+        "Add the words in the given entries"
+        words = set()
+        for entry in entries:
+            for text in [entry.title or "", entry.stripped_content]:
+                words.update(WORD.findall(text.lower()))
+            if len(words) > 10000:
+                cls._add(words, batch_size)
+                words = set()
+        cls._add(words, batch_size)
+
+    @classmethod
+    def _add(cls, words, batch_size):
+        words = sorted(words)
+        for i in range(0, len(words), batch_size):
+            batch = words[i:i + batch_size]
+            db.execute_sql(
+                "INSERT OR IGNORE INTO searchword (word) VALUES {}"
+                .format(", ".join("(?)" for _ in batch)), batch)
+
+    @classmethod
+    def containing(cls, part, at_end=False):
+        """The words that contain the given part (or end with it), or
+        None if there are too many of them."""
+        pattern = "%" + part + ("" if at_end else "%")
+        words = [row.word for row in
+                 cls.select(cls.word)
+                 .where(SQL("word LIKE ?", pattern))
+                 .limit(cls.MAX_MATCHES + 1)]
+        if len(words) <= cls.MAX_MATCHES:
+            return words
+
+
+class EntryAttribute(Model):
+
+    """
+    The attributes and metadata of each entry, extracted into separate
+    rows so that they can be searched using an index. Lists (e.g.
+    multioption attributes) get one row per element.
+    """
+
+    class Meta:
+        database = db
+        indexes = (
+            (("namespace", "name", "value"), False),
+        )
+
+    entry = ForeignKeyField(Entry, related_name="attribute_values")
+    namespace = CharField()  # "attributes" or "metadata"
+    name = CharField()
+    value = CharField(constraints=[SQL("COLLATE NOCASE")])
+
+    @staticmethod
+    def index_value(value):
+        "Represent a value as a string for the index"
+        if isinstance(value, float) and value.is_integer():
+            # numbers are stored as floats, but "1" should match 1.0
+            value = int(value)
+        if isinstance(value, (dict, list)):
+            return json.dumps(value, cls=CustomJSONEncoder)
+        return str(value)
+
+    @classmethod
+    def index_entries(cls, entries):
+        "Add the given entries to the index, replacing any old values"
+        for entry in entries:
+            cls.delete().where(cls.entry == entry.id).execute()
+            rows = []
+            for namespace in ("attributes", "metadata"):
+                for name, value in (getattr(entry, namespace) or {}).items():
+                    if value is None:
+                        continue
+                    for element in (value if isinstance(value, list)
+                                    else [value]):
+                        rows.append(dict(entry=entry.id,
+                                         namespace=namespace, name=name,
+                                         value=cls.index_value(element)))
+            if rows:
+                cls.insert_many(rows).execute()
+
+    @classmethod
+    def condition(cls, namespace, name, value):
+        """Return an SQL condition (and its variables) matching entries
+        where the given attribute/metadata has the value. Matching is
+        exact and case insensitive. A value ending with "*" (or "%")
+        matches as a prefix. For lists, matching any element is enough.
+        Other LIKE patterns are supported, but can't use the index."""
+        value = cls.index_value(value)
+        query = ("entry.id IN (SELECT entry_id FROM entryattribute"
+                 " WHERE namespace = ? AND name = ? AND {})")
+        if value[-1:] in ("*", "%") and "%" not in value[:-1]:
+            prefix = value[:-1]
+            return (query.format("value >= ? AND value < ?"),
+                    [namespace, name, prefix, prefix + "\U0010ffff"])
+        if "%" in value:
+            return ("json_extract(entry.{}, '$.{}') LIKE ?"
+                    .format(namespace, escape_string(name)), [value])
+        return query.format("value = ?"), [namespace, name, value]
+
+
+class EntryAuthor(Model):
+
+    """
+    The authors of each entry, extracted into separate rows. This makes
+    it easy to search for entries by author, and to find the authors
+    that are active in a logbook.
+    """
+
+    class Meta:
+        database = db
+        indexes = (
+            (("name", "login", "email"), False),
+        )
+
+    entry = ForeignKeyField(Entry, related_name="author_rows")
+    name = CharField(constraints=[SQL("COLLATE NOCASE")])
+    login = CharField(null=True)
+    email = CharField(null=True)
+
+    # Matches entries that have an author whose name matches a regexp.
+    # The grouping means that the regexp is only checked once for each
+    # distinct name, using the index.
+    # TODO: maybe also take login?
+    CONDITION = ("entry.id IN (SELECT entry_id FROM entryauthor"
+                 " WHERE name IN (SELECT name FROM entryauthor"
+                 " GROUP BY name HAVING name REGEXP ?))")
+
+    @classmethod
+    def index_entries(cls, entries):
+        "Add the given entries to the index, replacing any old authors"
+        for entry in entries:
+            cls.delete().where(cls.entry == entry.id).execute()
+            rows = []
+            for author in entry.authors or []:
+                if not isinstance(author, dict):
+                    author = {"name": author}
+                if not author.get("name"):
+                    continue
+                rows.append(dict(entry=entry.id, name=author["name"],
+                                 login=author.get("login"),
+                                 email=author.get("email")))
+            if rows:
+                cls.insert_many(rows).execute()
+
+    @classmethod
+    def search(cls, search="", logbook=None, n=20):
+        """Find distinct authors, whose name or login starts with the
+        given string (or with any word in the name). Returns dicts
+        with "name", "login" and "email", most frequent first."""
+        query = (cls.select(cls.name, fn.max(cls.login).alias("login"),
+                            fn.max(cls.email).alias("email"))
+                 .group_by(cls.name)
+                 .order_by(fn.count(cls.id).desc(), cls.name)
+                 .limit(n))
+        if search:
+            prefix = (search.replace("\\", "\\\\").replace("%", "\\%")
+                      .replace("_", "\\_")) + "%"
+            query = query.where(
+                SQL("name LIKE ? ESCAPE '\\'"
+                    " OR name LIKE ? ESCAPE '\\'"
+                    " OR login LIKE ? ESCAPE '\\'",
+                    prefix, "% " + prefix, prefix))
+        if logbook:
+            query = (query.join(Entry)
+                     .where((Entry.logbook == logbook) & ~Entry.archived))
+        return [dict(name=author.name, login=author.login,
+                     email=author.email)
+                for author in query.naive()]
+
+
+class EntrySummary(Model):
+
+    """
+    Aggregated information about each entry and its followups, as
+    needed for listing threads. Keeping it here means the listing does
+    not have to go through all the followups every time. It's updated
+    whenever an entry or attachment is saved.
+    """
+
+    class Meta:
+        database = db
+        indexes = (
+            (("logbook", "priority", "timestamp"), False),
+        )
+
+    entry = ForeignKeyField(Entry, primary_key=True, related_name="summary")
+    logbook = ForeignKeyField(Logbook, related_name="entry_summaries")
+    priority = IntegerField(default=0)
+    # the latest modification time in the thread, as sqlite datetime
+    timestamp = CharField()
+    n_followups = IntegerField(default=0)
+    # JSON list of the names of all followup authors
+    followup_authors = TextField(default="[]")
+    n_attachments = IntegerField(default=0)
+
+    @classmethod
+    def update_entries(cls, entry_ids=None):
+        """Recalculate the summary of the given entries. If no entries
+        are given, all of them are updated."""
+        query = """
+        INSERT OR REPLACE INTO entrysummary
+            (entry_id, logbook_id, priority, timestamp, n_followups,
+             followup_authors, n_attachments)
+        SELECT entry.id, entry.logbook_id, entry.priority,
+            max(datetime(coalesce(coalesce(followup.last_changed_at,followup.created_at),
+                coalesce(entry.last_changed_at,entry.created_at)))),
+            count(followup.id),
+            -- distinct names of all the followup authors
+            (SELECT json_group_array(name) FROM (
+                SELECT entryauthor.name FROM entryauthor
+                JOIN entry AS followup2
+                    ON followup2.id = entryauthor.entry_id
+                WHERE followup2.follows_id = entry.id
+                GROUP BY entryauthor.name
+                ORDER BY min(entryauthor.id))),
+            (SELECT count(*) FROM attachment
+             WHERE attachment.entry_id = entry.id)
+        FROM entry
+        LEFT JOIN entry AS followup ON entry.id == followup.follows_id
+        """
+        variables = []
+        if entry_ids is not None:
+            if not entry_ids:
+                return
+            query += " WHERE entry.id IN ({})".format(
+                ", ".join("?" for _ in entry_ids))
+            variables.extend(entry_ids)
+        query += " GROUP BY entry.id"
+        db.execute_sql(query, variables)
 
 
 class EntryChange(Model):
@@ -862,11 +2210,131 @@ class EntryChange(Model):
     change_comment = TextField(null=True)
     change_ip = CharField(null=True)
 
+    # filled in by Entry.get_changes()
+    old_values = new_values = None
+
+    # Old contents are stored as patches against the newer content,
+    # except for every KEYFRAME_INTERVAL:th content change, so that
+    # we don't need to go through too many patches to get it back.
+    KEYFRAME_INTERVAL = 10
+
+    def save(self, *args, **kwargs):
+        with db.atomic():
+            if self.id is None:
+                EntrySnapshot.make_if_needed(self)
+                self.compress_content()
+            return super().save(*args, **kwargs)
+
+    @property
+    def changed_fields(self):
+        "The names of the fields that were changed"
+        return [("content" if attr == "content_patch" else attr)
+                for attr in self.changed]
+
+    def _content_changes(self):
+        return (EntryChange.select()
+                .where((EntryChange.entry == self.entry) &
+                       ((EntryChange.changed.extract("content") != None) |
+                        (EntryChange.changed.extract("content_patch") != None))))
+
+    def compress_content(self):
+        """Replace the old content with a patch that takes us there
+        from the new content, unless it's time for a keyframe. Must be
+        done before the change is first saved."""
+        old = self.changed.get("content")
+        new = self.entry.content
+        if old is None or new is None:
+            return
+        recent = (self._content_changes()
+                  .order_by(EntryChange.id.desc())
+                  .limit(self.KEYFRAME_INTERVAL - 1))
+        n_patches = 0
+        for change in recent:
+            if "content_patch" not in change.changed:
+                break
+            n_patches += 1
+        if n_patches < self.KEYFRAME_INTERVAL - 1:
+            patch = make_patch(new, old)
+            if len(patch) < len(old):
+                del self.changed["content"]
+                self.changed["content_patch"] = patch
+
+    def get_content(self, after=False):
+        """Get the content before (or after) this change. Since it may
+        be stored as patches, we start from the next later keyframe, or
+        the entry itself, and apply the patches back to here."""
+        if after:
+            later = self._content_changes().where(EntryChange.id > self.id)
+        else:
+            later = self._content_changes().where(EntryChange.id >= self.id)
+        patches = []
+        for change in later.order_by(EntryChange.id):
+            if "content" in change.changed:
+                content = change.changed["content"]
+                break
+            patches.append(change.changed["content_patch"])
+        else:
+            content = self.entry.content
+        for patch in reversed(patches):
+            content = apply_patch(content, patch)
+        return content
+
+    @classmethod
+    def compact_entry(cls, entry):
+        """Convert the content history of the entry into patches and
+        keyframes, e.g. for changes made before patches were used.
+        Returns the number of changes that were rewritten."""
+        changes = list(cls.select()
+                       .where(cls.entry == entry)
+                       .order_by(cls.id))
+        # first get all the old contents, going backwards
+        contents = []
+        content = entry.content
+        for change in reversed(changes):
+            if "content" in change.changed:
+                content = change.changed["content"]
+            elif "content_patch" in change.changed:
+                content = apply_patch(content, change.changed["content_patch"])
+            contents.append(content)
+        contents.reverse()
+        # then store them again in the same way as compress_content()
+        n_patches = 0
+        n_rewritten = 0
+        for i, change in enumerate(changes):
+            if not set(["content", "content_patch"]) & set(change.changed):
+                continue
+            changed = dict(change.changed)
+            changed.pop("content_patch", None)
+            changed["content"] = old = contents[i]
+            new = next((contents[j] for j in range(i + 1, len(changes))
+                        if set(["content", "content_patch"])
+                        & set(changes[j].changed)), entry.content)
+            if (old is not None and new is not None
+                    and n_patches < cls.KEYFRAME_INTERVAL - 1):
+                patch = make_patch(new, old)
+                if len(patch) < len(old):
+                    del changed["content"]
+                    changed["content_patch"] = patch
+            if "content_patch" in changed:
+                n_patches += 1
+            else:
+                n_patches = 0
+            if changed != change.changed:
+                (cls.update(changed=changed)
+                 .where(cls.id == change.id)
+                 .execute())
+                n_rewritten += 1
+        return n_rewritten
+
     def get_old_value(self, attr):
 
         """Get the value of the attribute at the time of this revision.
         That is, *before* the change happened."""
 
+        if self.old_values is not None and attr in self.old_values:
+            return self.old_values[attr]
+        if attr == "content":
+            return self.get_content()
         # First check if the attribute was changed in this revision,
         # in that case we return the stored value.
         if attr in self.changed:
@@ -892,6 +2360,10 @@ class EntryChange(Model):
         """Get the value of the attribute after this revision happened.
         If it was not changed, it'll just be the same as before."""
 
+        if self.new_values is not None and attr in self.new_values:
+            return self.new_values[attr]
+        if attr == "content":
+            return self.get_content(after=True)
         # Check for the next revision where this attribute changed;
         # the value from there must also be the value after this
         # revision.
@@ -909,13 +2381,91 @@ class EntryChange(Model):
             return getattr(self.entry, attr)
 
 
+class EntrySnapshot(Model):
+
+    """
+    A full copy of a historical version of an entry, stored every
+    INTERVAL changes. Since changes only contain the old values of
+    the fields that were changed, an old revision can then be
+    reconstructed from the nearest later snapshot instead of going
+    through all the changes.
+    """
+
+    class Meta:
+        database = db
+        indexes = (
+            (("entry", "revision_n"), True),
+        )
+
+    INTERVAL = 10
+
+    # the fields of the entry that are part of a revision
+    FIELDS = ("logbook_id", "title", "authors", "content", "attributes",
+              "metadata", "follows_id", "archived")
+
+    entry = ForeignKeyField(Entry, related_name="snapshots")
+    revision_n = IntegerField()
+    data = CustomJSONField()
+
+    @classmethod
+    def make_if_needed(cls, change):
+        """Called before saving a new change. If it's time, store what
+        the entry looked like before the change."""
+        # make_change has already counted this change, so this is the
+        # number of earlier changes, i.e. the revision before it. No
+        # need to count them in the database.
+        revision_n = change.entry.revision_n - 1
+        if revision_n == 0 or revision_n % cls.INTERVAL:
+            return
+        # At this point the entry has the new values, but the change
+        # has the old values of everything that was changed.
+        data = {attr: change.changed.get(attr, getattr(change.entry, attr))
+                for attr in cls.FIELDS}
+        cls.create(entry=change.entry, revision_n=revision_n, data=data)
+
+
 class EntryRevision:
 
     """An object that represents a historical version of an entry. It
     can (basically) be used like an Entry object."""
 
-    def __init__(self, change):
+    def __init__(self, change, values=None, revision_n=None):
         self.change = change
+        self._values = values
+        self._revision_n = revision_n
+
+    @classmethod
+    def reconstruct(cls, entry, version, revision_n):
+        """Get the given revision of the entry, starting from the
+        nearest snapshot (or the current entry) and going back."""
+        snapshot = (EntrySnapshot.select()
+                    .where((EntrySnapshot.entry == entry) &
+                           (EntrySnapshot.revision_n >= version))
+                    .order_by(EntrySnapshot.revision_n)
+                    .first())
+        if snapshot:
+            values = dict(snapshot.data)
+            end = snapshot.revision_n
+        else:
+            values = {attr: getattr(entry, attr)
+                      for attr in EntrySnapshot.FIELDS}
+            end = revision_n
+        # the change following the revision is needed in any case
+        changes = list(EntryChange.select()
+                       .where(EntryChange.entry == entry)
+                       .order_by(EntryChange.id)
+                       .offset(version)
+                       .limit(max(end - version, 1)))
+        for change in reversed(changes[:end - version]):
+            values.update((attr, value)
+                          for attr, value in change.changed.items()
+                          if attr in values)
+            if "content_patch" in change.changed:
+                values["content"] = apply_patch(
+                    values["content"], change.changed["content_patch"])
+        change = changes[0]
+        change.entry = entry
+        return cls(change, values, version)
 
     @property
     def logbook(self):
@@ -925,13 +2475,20 @@ class EntryRevision:
         if attr == "id":
             return self.change.entry.id
         if attr == "revision_n":
-            return list(self.change.entry.changes).index(self.change)
+            if self._revision_n is None:
+                self._revision_n = (EntryChange.select()
+                                    .where((EntryChange.entry == self.change.entry) &
+                                           (EntryChange.id < self.change.id))
+                                    .count())
+            return self._revision_n
+        if self._values is not None and attr in self._values:
+            return self._values[attr]
         if attr in ("logbook_id", "title", "authors", "content", "attributes",
                     "metadata", "follows_id", "tags", "archived"):
             return self.change.get_old_value(attr)
         if attr == "converted_attributes":
             return convert_attributes(self.change.entry.logbook,
-                                      self.change.get_old_value("attributes"))
+                                      self.attributes)
         return getattr(self.change.entry, attr)
 
 
@@ -986,6 +2543,12 @@ class EntryLock(Model):
     def locked(self):
         return not self.cancelled_at and self.expires_at > datetime.utcnow()
 
+    @classmethod
+    def active(cls):
+        "Condition for locks that are in effect"
+        return ((cls.expires_at > datetime.utcnow()) &
+                (cls.cancelled_at == None))
+
     def cancel(self, ip):
         self.cancelled_at = datetime.utcnow()
         self.cancelled_by_ip = ip
@@ -1011,6 +2574,36 @@ class Attachment(Model):
     metadata = JSONField(null=True)  # may contain image size, etc
     archived = BooleanField(default=False)
 
+    def save(self, *args, **kwargs):
+        with db.atomic():
+            entry_ids = {self.entry_id}
+            if self.id is not None and "entry" in self._dirty:
+                # moved from another entry, which also changes
+                entry_ids.add(Attachment.select(Attachment.entry)
+                              .where(Attachment.id == self.id).scalar())
+            result = super().save(*args, **kwargs)
+            self._entries_changed(entry_ids)
+        return result
+
+    def delete_instance(self, *args, **kwargs):
+        with db.atomic():
+            result = super().delete_instance(*args, **kwargs)
+            self._entries_changed({self.entry_id})
+        return result
+
+    @staticmethod
+    def _entries_changed(entry_ids):
+        # The entry's attachments are part of it, so anyone following
+        # the changes (see ChangeSequence) must get it again. This is
+        # not a new revision of the entry though, since that is only
+        # about the entry's own fields.
+        entry_ids = [entry_id for entry_id in entry_ids
+                     if entry_id is not None]
+        if entry_ids:
+            (Entry.update(change_seq=ChangeSequence.next())
+             .where(Entry.id << entry_ids).execute())
+            EntrySummary.update_entries(entry_ids)
+
     @property
     def link(self):
         return url_for("get_attachment", path=self.path)
@@ -1018,3 +2611,89 @@ class Attachment(Model):
     @property
     def thumbnail_link(self):
         return url_for("get_attachment", path=self.path) + ".thumbnail"
+
+
+class QueuedAction(Model):
+    """An action (see actions.py) waiting to be run. The queue is kept
+    in the database, so that nothing is lost if the app is restarted
+    before the action has been run, or while it's running. Rows are
+    removed once the action has succeeded, while actions that keep
+    failing are kept around for inspection."""
+
+    class Meta:
+        database = db
+        indexes = (
+            (("finished", "run_at"), False),
+        )
+
+    signal = CharField()
+    data = CustomJSONField()  # the arguments to the action
+    created_at = UTCDateTimeField(default=datetime.utcnow)
+    # don't run it before this, e.g. when retrying
+    run_at = UTCDateTimeField(default=datetime.utcnow)
+    # set while some worker is running it
+    started_at = UTCDateTimeField(null=True)
+    attempts = IntegerField(default=0)
+    error = TextField(null=True)
+    # set when we have given up on it
+    finished = BooleanField(default=False)
+
+    @classmethod
+    def claim(cls, busy=(), timeout=300):
+        """Pick the next action that is due, and mark it as started.
+        Actions for signals in 'busy' are skipped. An action that was
+        started more than 'timeout' seconds ago is assumed to have
+        been abandoned (e.g. the app was restarted) and is run again.
+        Returns None if there's nothing to do."""
+        now = datetime.utcnow()
+        abandoned = now - timedelta(seconds=timeout)
+        query = (cls.select()
+                 .where((cls.finished == False) &
+                        (cls.run_at <= now) &
+                        ((cls.started_at == None) |
+                         (cls.started_at < abandoned)))
+                 .order_by(cls.run_at, cls.id))
+        if busy:
+            query = query.where(cls.signal.not_in(list(busy)))
+        for action in query.limit(10):
+            # Several workers (maybe in other processes) may be trying
+            # to claim the same action; only one can succeed.
+            claimed = (cls.update(started_at=now, attempts=cls.attempts + 1)
+                       .where((cls.id == action.id) &
+                              (cls.attempts == action.attempts))
+                       .execute())
+            if claimed:
+                action.started_at = now
+                action.attempts += 1
+                return action
+
+    def retry(self, error, delay):
+        "Run the action again after a while"
+        self.error = error
+        self.started_at = None
+        self.run_at = datetime.utcnow() + timedelta(seconds=delay)
+        self.save()
+
+    def give_up(self, error):
+        self.error = error
+        self.started_at = None
+        self.finished = True
+        self.save()
+
+    @classmethod
+    def get_queue_stats(cls):
+        """Number of waiting, running and failed actions, and the
+        creation time of the oldest waiting one, per signal"""
+        query = (cls.select(
+            cls.signal,
+            fn.SUM(SQL("started_at IS NULL AND NOT finished")),
+            fn.SUM(SQL("started_at IS NOT NULL AND NOT finished")),
+            fn.SUM(SQL("finished")),
+            fn.MIN(SQL("CASE WHEN NOT finished THEN created_at END")))
+                 .group_by(cls.signal)
+                 .order_by(cls.signal)
+                 .tuples())
+        return {signal: dict(waiting=waiting, running=running,
+                             failed=failed,
+                             oldest=cls.created_at.python_value(oldest))
+                for signal, waiting, running, failed, oldest in query}
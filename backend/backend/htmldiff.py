@@ -19,10 +19,10 @@ try:
     from io import StringIO
 except ImportError:
     from io import StringIO
-import cgi
+import html
 
-def htmlEncode(s, esc=cgi.escape):
-    return esc(s, 1)
+def htmlEncode(s, esc=html.escape):
+    return esc(s, True)
 
 commentRE = re.compile('<!--.*?-->', re.S)
 tagRE = re.compile('<script.*?>.*?</script>|<.*?>', re.S)
@@ -115,28 +115,30 @@ class HTMLMatcher(SequenceMatcher):
                 return False
         return True
 
+    # Note: collecting the text in a list and joining it, instead of
+    # adding up strings, keeps this linear for large changes.
     def textDelete(self, lst, out):
-        text = ''
+        text = []
         for item in lst:
             if item.startswith('<'):
-                self.outDelete(text, out)
-                text = ''
+                self.outDelete(''.join(text), out)
+                text = []
                 out.write(self.formatDeleteTag(item))
             else:
-                text += item
-        self.outDelete(text, out)
+                text.append(item)
+        self.outDelete(''.join(text), out)
 
     def textInsert(self, lst, out):
-        text = ''
+        text = []
         for item in lst:
             if item.startswith('<'):
-                self.outInsert(text, out)
-                text = ''
+                self.outInsert(''.join(text), out)
+                text = []
                 out.write(self.formatInsertTag(item))
                 out.write(item)
             else:
-                text += item
-        self.outInsert(text, out)
+                text.append(item)
+        self.outInsert(''.join(text), out)
 
     def outDelete(self, s, out):
         if s.strip() == '':
@@ -12,6 +12,16 @@ import re
 
 _no_eol = "\ No newline at end of file"
 _hdr_pat = re.compile("^@@ -(\d+),?(\d+)? \+(\d+),?(\d+)? @@$")
+_line_pat = re.compile("[^\n]*\n|[^\n]+")
+
+
+def _lines(s):
+    """
+    Split a string into lines, keeping the line endings. Unlike
+    str.splitlines, only splits on newlines, since other characters
+    like form feeds may appear in the content, and in the patches.
+    """
+    return _line_pat.findall(s)
 
 
 def make_patch(a, b):
@@ -19,7 +29,7 @@ def make_patch(a, b):
     Get unified string diff between two strings. Trims top two lines.
     Returns empty string if strings are identical.
     """
-    diffs = difflib.unified_diff(a.splitlines(True), b.splitlines(True), n=0)
+    diffs = difflib.unified_diff(_lines(a), _lines(b), n=0)
     try:
         _, _ = next(diffs), next(diffs)
     except StopIteration:
@@ -34,8 +44,8 @@ def apply_patch(s, patch, revert=False):
     Apply patch to string s to recover newer string.
     If revert is True, treat s as the newer string, recover older string.
     """
-    s = s.splitlines(True)
-    p = patch.splitlines(True)
+    s = _lines(s)
+    p = _lines(patch)
     t = ''
     i = sl = 0
     (midx, sign) = (1, '+') if not revert else (3, '-')
@@ -63,7 +73,7 @@ def apply_patch(s, patch, revert=False):
                 if line[0] == sign or line[0] == ' ':
                     t += line[1:]
                 sl += (line[0] != sign)
-                t += ''.join(s[sl:])
+    t += ''.join(s[sl:])
     return t
 
 #
@@ -23,6 +23,17 @@ UPLOAD_FOLDER = os.getenv('ELOGY_UPLOAD_FOLDER', '/tmp/elogy')  # !!!Again, /tmp
 LDAP_SERVER = os.getenv("ELOGY_LDAP_SERVER", "")
 LDAP_BASEDN = os.getenv("ELOGY_LDAP_BASEDN", "")
 
+# Searches that take longer than this (in seconds) are cancelled.
+SEARCH_TIME_LIMIT = float(os.getenv("ELOGY_SEARCH_TIME_LIMIT", 10))
+
+# How many API responses to keep around, for clients that ask for the
+# same things over and over.
+RESPONSE_CACHE_SIZE = int(os.getenv("ELOGY_RESPONSE_CACHE_SIZE", 1000))
+
+# The longest time (in seconds) a client may wait for something to
+# change, when asking for changes.
+CHANGES_MAX_WAIT = float(os.getenv("ELOGY_CHANGES_MAX_WAIT", 60))
+
 
 # Callbacks for various events
 
@@ -38,8 +49,9 @@ def new_entry(data):
     # scripts to accidentally modify the database...
 
     # Should be OK to do potentially slow stuff here such as network
-    # calls, since actions are run in a thread. But make sure it
-    # terminates sooner or later or you will have a resource leak!
+    # calls, since actions are run in the background. But make sure it
+    # terminates sooner or later, or it will hold up a worker! If it
+    # raises an exception, it will be retried later.
 
     # Some example actions:
     if "Mailto" in entry["attributes"]:
@@ -88,6 +100,26 @@ ACTIONS = {
     "edit_logbook": None  # edit_logbook
 }
 
+# Actions are queued in the database, and run by this many worker
+# threads (per process).
+ACTION_WORKERS = int(os.getenv("ELOGY_ACTION_WORKERS", 4))
+
+# The most actions of each kind that may run at the same time (per
+# process), e.g. to go easy on the mail server.
+ACTION_CONCURRENCY = {
+    "new_entry": 2
+}
+
+# A failed action is tried again after ACTION_RETRY_DELAY seconds,
+# then after twice that, and so on, up to ACTION_MAX_ATTEMPTS times
+# in total. Failed actions are kept in the database.
+ACTION_RETRY_DELAY = 10
+ACTION_MAX_ATTEMPTS = 5
+
+# An action that has been running for longer than this (in seconds) is
+# assumed to have been interrupted, e.g. by a restart, and is run again.
+ACTION_TIMEOUT = 300
+
 
 # Don't change anything below this line unless you know what you're doing!
 # ------------------------------------------------------------------------
@@ -85,6 +85,59 @@ def test_update_logbook(elogy_client):
     assert response["name"] == "New name"
 
 
+def test_logbook_tree(elogy_client):
+    in_logbook, logbook = make_logbook(elogy_client)
+    in_child, child = make_logbook(elogy_client, dict(
+        name="Child logbook", parent_id=logbook["id"]))
+
+    def get_tree():
+        return decode_response(elogy_client.get("/api/logbooks/"))["logbook"]
+
+    tree = get_tree()
+    top = next(lb for lb in tree["children"] if lb["id"] == logbook["id"])
+    assert [c["name"] for c in top["children"]] == ["Child logbook"]
+    assert top["children"][0]["parent"] == {"id": logbook["id"],
+                                            "name": logbook["name"]}
+
+    # changes must show up right away
+    elogy_client.put("/api/logbooks/{}/".format(child["id"]),
+                     data=dict(name="New name", parent_id=logbook["id"]))
+    top = next(lb for lb in get_tree()["children"]
+               if lb["id"] == logbook["id"])
+    assert [c["name"] for c in top["children"]] == ["New name"]
+
+    elogy_client.put("/api/logbooks/{}/".format(child["id"]),
+                     data=dict(name="New name", parent_id=logbook["id"],
+                               archived=True))
+    top = next(lb for lb in get_tree()["children"]
+               if lb["id"] == logbook["id"])
+    assert top["children"] == []
+
+    # archived logbooks can still be fetched
+    result = decode_response(elogy_client.get(
+        "/api/logbooks/{}/".format(child["id"])))["logbook"]
+    assert result["archived"]
+
+
+def test_logbook_tree_changed_meanwhile(elogy_client, monkeypatch):
+    from elogy.api import logbooks
+    from elogy.db import Logbook
+    in_logbook, logbook = make_logbook(elogy_client)
+    get_tree = Logbook.get_tree
+
+    def get_tree_and_change():
+        tree = get_tree()
+        # e.g. another request changing a logbook
+        logbooks.clear_logbook_tree(None)
+        return tree
+
+    monkeypatch.setattr(Logbook, "get_tree", get_tree_and_change)
+    tree = decode_response(elogy_client.get("/api/logbooks/"))["logbook"]
+    assert logbook["id"] in [c["id"] for c in tree["children"]]
+    # the tree may be out of date, so it must not be kept
+    assert logbooks._logbook_tree["tree"] is None
+
+
 def test_move_logbook(elogy_client):
     in_logbook, logbook = make_logbook(elogy_client)
     in_logbook2, logbook2 = make_logbook(elogy_client)
@@ -108,6 +161,13 @@ def test_move_logbook(elogy_client):
 
     assert parent_logbook["children"][0]["id"] == logbook["id"]
 
+    # a logbook can't be moved into itself, or one of its descendants
+    for parent_id in [logbook2["id"], logbook["id"]]:
+        response = elogy_client.put(
+            "/api/logbooks/{}/".format(logbook2["id"]),
+            data=dict(parent_id=parent_id))
+        assert response.status_code == 400
+
 
 def test_create_entry(elogy_client):
     in_logbook, logbook = make_logbook(elogy_client)
@@ -497,3 +557,335 @@ def test_entry_search(elogy_client):
     URL = ("/api/logbooks/0/entries/?content=more")
     result = decode_response(elogy_client.get(URL))
     assert set([entry12["id"], entry13["id"], entry22["id"]]) == set(e["id"] for e in result["entries"])
+
+
+def test_entry_list_cursor(elogy_client):
+
+    in_logbook, logbook = make_logbook(elogy_client)
+    ids = [make_entry(elogy_client, logbook,
+                      {"title": "Entry {}".format(i),
+                       "content": "Content {}".format(i),
+                       "content_type": "text/plain"})[1]["id"]
+           for i in range(5)]
+
+    # page through the entries two at a time
+    URL = "/api/logbooks/{logbook[id]}/entries/?n=2".format(logbook=logbook)
+    pages = []
+    result = decode_response(elogy_client.get(URL))
+    pages.append([e["id"] for e in result["entries"]])
+    while result["next_cursor"]:
+        result = decode_response(elogy_client.get(
+            URL + "&cursor=" + result["next_cursor"]))
+        pages.append([e["id"] for e in result["entries"]])
+
+    # newest first, and each entry exactly once
+    assert sum(pages, []) == list(reversed(ids))
+
+    response = elogy_client.get(URL + "&cursor=garbage")
+    assert response.status_code == 400
+
+
+def test_logbook_authors(elogy_client):
+
+    in_logbook, logbook = make_logbook(elogy_client)
+    for authors in [[{"name": "Ann Author", "login": "ann"}],
+                    [{"name": "Ann Author", "login": "ann"},
+                     {"name": "Bob Writer", "login": "bob"}]]:
+        make_entry(elogy_client, logbook,
+                   {"title": "Entry", "content": "Content",
+                    "content_type": "text/plain", "authors": authors})
+
+    # most frequent authors first
+    result = decode_response(elogy_client.get(
+        "/api/logbooks/{logbook[id]}/authors/".format(logbook=logbook)))
+    assert [a["name"] for a in result["authors"]] == ["Ann Author",
+                                                      "Bob Writer"]
+
+    # matching the start of any word in the name, or login
+    result = decode_response(elogy_client.get(
+        "/api/logbooks/{logbook[id]}/authors/?search=wri"
+        .format(logbook=logbook)))
+    assert [a["login"] for a in result["authors"]] == ["bob"]
+
+    # known authors are suggested first
+    result = decode_response(elogy_client.get("/api/users/?search=ann"))
+    assert result["users"][0]["login"] == "ann"
+
+    # filter entries by author
+    result = decode_response(elogy_client.get(
+        "/api/logbooks/{logbook[id]}/entries/?authors=bob"
+        .format(logbook=logbook)))
+    assert len(result["entries"]) == 1
+
+
+def test_entry_diff(elogy_client):
+    in_logbook, logbook = make_logbook(elogy_client)
+    in_entry, entry = make_entry(elogy_client, logbook, dict(
+        title="Entry", content="<p>Hello world!</p>",
+        content_type="text/html"))
+    url = ("/api/logbooks/{logbook[id]}/entries/{entry[id]}/"
+           .format(logbook=logbook, entry=entry))
+    elogy_client.put(url, data=dict(content="<p>Hello you!</p>",
+                                    revision_n=entry["revision_n"]))
+
+    result = decode_response(elogy_client.get(url + "diff/?from=0"))
+    assert result["diff"]["to"] == 1
+    assert result["diff"]["content"] == (
+        "<p>Hello <del>world!</del><ins>you!</ins></p>")
+
+    # diffing backwards also works
+    result = decode_response(elogy_client.get(url + "diff/?from=1&to=0"))
+    assert result["diff"]["content"] == (
+        "<p>Hello <del>you!</del><ins>world!</ins></p>")
+
+    result = elogy_client.get(url + "diff/?from=0&to=2")
+    assert result.status_code == 404
+
+
+def test_entries_stream(elogy_client):
+    in_logbook, logbook = make_logbook(elogy_client)
+    for i in range(5):
+        make_entry(elogy_client, logbook)
+    url = "/api/logbooks/{logbook[id]}/entries/?n=3".format(logbook=logbook)
+    expected = decode_response(elogy_client.get(url))
+
+    # the streamed response should contain the same thing
+    result = decode_response(elogy_client.get(url + "&stream=json"))
+    assert result == expected
+    assert result["next_cursor"]
+
+    # one entry per line
+    response = elogy_client.get(url + "&stream=ndjson")
+    assert response.mimetype == "application/x-ndjson"
+    lines = response.get_data().decode("utf-8").splitlines()
+    assert [json.loads(line) for line in lines] == expected["entries"]
+
+
+def test_entries_ranked_search(elogy_client):
+    in_logbook, logbook = make_logbook(elogy_client)
+    make_entry(elogy_client, logbook,
+               {"title": "The beam was lost again", "content": "Hello"})
+    make_entry(elogy_client, logbook,
+               {"title": "Nothing to see here", "content": "Hello"})
+    url = "/api/logbooks/{logbook[id]}/entries/".format(logbook=logbook)
+
+    # normal listings have no snippets
+    result = decode_response(elogy_client.get(url))
+    assert len(result["entries"]) == 2
+    assert all("snippet" not in e for e in result["entries"])
+
+    result = decode_response(elogy_client.get(url + "?title=beam&ranked=1"))
+    entry, = result["entries"]
+    assert "<mark>beam</mark>" in entry["snippet"]
+    streamed = decode_response(
+        elogy_client.get(url + "?title=beam&ranked=1&stream=json"))
+    assert streamed == result
+
+    # ranking can't be done on regexps, or without a search
+    response = elogy_client.get(url + "?title=be.m&ranked=1")
+    assert response.status_code == 400
+    response = elogy_client.get(url + "?ranked=1")
+    assert response.status_code == 400
+
+
+def test_response_cache(elogy_client):
+    in_logbook, logbook = make_logbook(elogy_client)
+    in_entry, entry = make_entry(elogy_client, logbook)
+    entries_url = ("/api/logbooks/{logbook[id]}/entries/"
+                   .format(logbook=logbook))
+    entry_url = entries_url + "{entry[id]}/".format(entry=entry)
+
+    response = elogy_client.get(entries_url)
+    etag = response.headers["ETag"]
+    assert etag.startswith('"')
+    response = elogy_client.get(entries_url,
+                                headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    # a new entry must show up, with a new ETag
+    make_entry(elogy_client, logbook)
+    response = elogy_client.get(entries_url,
+                                headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert len(decode_response(response)["entries"]) == 2
+    assert response.headers["ETag"] != etag
+
+    # taking a lock changes the entry
+    assert decode_response(elogy_client.get(entry_url))["entry"]["lock"] is None
+    elogy_client.post(entry_url + "lock")
+    assert decode_response(elogy_client.get(entry_url))["entry"]["lock"]
+    elogy_client.delete(entry_url + "lock")
+    assert decode_response(elogy_client.get(entry_url))["entry"]["lock"] is None
+
+
+def test_logbook_events(elogy_client):
+    in_logbook, logbook = make_logbook(elogy_client)
+    child = decode_response(
+        post_json(elogy_client,
+                  "/api/logbooks/{logbook[id]}/".format(logbook=logbook),
+                  data={"name": "Child logbook"}))["logbook"]
+    in_other, other = make_logbook(elogy_client)
+
+    response = elogy_client.get(
+        "/api/logbooks/{logbook[id]}/events/".format(logbook=logbook),
+        buffered=False)
+    assert response.mimetype == "text/event-stream"
+    other_response = elogy_client.get(
+        "/api/logbooks/{logbook[id]}/events/".format(logbook=other),
+        buffered=False)
+    events = iter(response.response)
+    assert next(events).startswith(b"retry: ")
+
+    # entries in descendants also count
+    in_entry, entry = make_entry(elogy_client, child)
+    event = next(events).decode("utf-8")
+    assert event.startswith("event: new_entry\n")
+    data = json.loads(event.split("data: ")[1])
+    assert data["entry_id"] == entry["id"]
+    assert data["logbook_id"] == child["id"]
+    assert data["revision_n"] == 0
+
+    entry_url = ("/api/logbooks/{logbook[id]}/entries/{entry[id]}/"
+                 .format(logbook=child, entry=entry))
+    elogy_client.post(entry_url + "lock")
+    assert next(events).decode("utf-8").startswith("event: lock\n")
+    elogy_client.put(entry_url, data={**in_entry, "title": "New title",
+                                      "revision_n": 0})
+    # saving the entry also releases the lock
+    received = {}
+    for _ in range(2):
+        event_type, data = next(events).decode("utf-8").split("\n")[:2]
+        received[event_type] = json.loads(data[len("data: "):])
+    assert set(received) == {"event: edit_entry", "event: unlock"}
+    assert received["event: edit_entry"]["revision_n"] == 1
+
+    # changes made elsewhere, e.g. by another process, are also found
+    from elogy.db import Entry
+    other_entry = Entry.create(logbook=child["id"], title="From elsewhere")
+    event = next(events).decode("utf-8")
+    assert event.startswith("event: new_entry\n")
+    assert json.loads(event.split("data: ")[1])["entry_id"] == other_entry.id
+    response.close()
+
+    # nothing happened in the other logbook
+    from elogy.api.events import broker
+    subscription, = broker._subscriptions
+    assert subscription.logbook_id == other["id"]
+    assert subscription.queue.empty()
+    other_response.close()
+    assert not broker._subscriptions
+
+
+def test_changes(elogy_client):
+    in_logbook, logbook = make_logbook(elogy_client)
+    changes_url = ("/api/logbooks/{logbook[id]}/changes/"
+                   .format(logbook=logbook))
+    changed = decode_response(elogy_client.get(changes_url))["changed"]
+    assert [lb["id"] for lb in changed["logbooks"]] == [logbook["id"]]
+    assert changed["entries"] == []
+    cursor = changed["cursor"]
+
+    # nothing new; waits a little and gives up
+    changed = decode_response(
+        elogy_client.get(changes_url,
+                         query_string={"since": cursor, "wait": 0.1}))["changed"]
+    assert changed == {"logbooks": [], "entries": [], "cursor": cursor}
+
+    in_entry, entry = make_entry(elogy_client, logbook)
+    changed = decode_response(
+        elogy_client.get(changes_url,
+                         query_string={"since": cursor}))["changed"]
+    assert changed["logbooks"] == []
+    changed_entry, = changed["entries"]
+    assert changed_entry["id"] == entry["id"]
+    assert changed_entry["revision_n"] == 0
+    assert changed_entry["change_seq"] == entry["change_seq"]
+    assert changed["cursor"] == entry["change_seq"]
+
+
+def test_actions(elogy_client):
+    from elogy.app import app
+    from elogy.actions import workers
+
+    calls = []
+
+    def action(data):
+        calls.append(data["entry"]["id"])
+        if len(calls) == 1:
+            raise RuntimeError("Mail server down")
+
+    app.config.update(ACTIONS={"new_entry": action}, ACTION_WORKERS=0,
+                      ACTION_RETRY_DELAY=0)
+    try:
+        in_logbook, logbook = make_logbook(elogy_client)
+        # the action is only queued
+        in_entry, entry = make_entry(elogy_client, logbook)
+        assert calls == []
+        actions = decode_response(elogy_client.get("/api/actions/"))
+        stats, = actions["actions"]
+        assert stats["signal"] == "new_entry"
+        assert stats["waiting"] == 1
+
+        # fails the first time, is retried
+        assert workers.run_next(app.config)
+        assert workers.run_next(app.config)
+        assert not workers.run_next(app.config)
+        assert calls == [entry["id"], entry["id"]]
+
+        stats, = decode_response(elogy_client.get("/api/actions/"))["actions"]
+        assert stats["waiting"] == 0
+        assert stats["succeeded"] == 1
+        assert stats["errors"] == 1
+    finally:
+        for key in ["ACTIONS", "ACTION_WORKERS", "ACTION_RETRY_DELAY"]:
+            del app.config[key]
+
+
+def test_actions_queued_with_change(elogy_client, monkeypatch):
+    from elogy.app import app
+    from elogy.db import QueuedAction
+
+    in_logbook, logbook = make_logbook(elogy_client)
+    entries_url = ("/api/logbooks/{logbook[id]}/entries/"
+                   .format(logbook=logbook))
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("Database trouble")
+
+    # if the action can't be queued, the entry isn't saved either
+    monkeypatch.setattr(QueuedAction, "create", fail)
+    app.config.update(ACTIONS={"new_entry": lambda data: None},
+                      ACTION_WORKERS=0)
+    try:
+        response = post_json(elogy_client, entries_url,
+                             data=dict(title="Lost", content="Hello"))
+        assert response.status_code == 500
+    finally:
+        for key in ["ACTIONS", "ACTION_WORKERS"]:
+            del app.config[key]
+    assert decode_response(
+        elogy_client.get(entries_url + "?n=998"))["entries"] == []
+
+
+def test_entries_stream_timeout(elogy_client):
+    from elogy.app import app
+    in_logbook, logbook = make_logbook(elogy_client)
+    for i in range(20):
+        make_entry(elogy_client, logbook)
+    url = ("/api/logbooks/{logbook[id]}/entries/?content=s.*t"
+           .format(logbook=logbook))
+
+    # the status has already been sent when the search times out,
+    # so the document must say so
+    app.config["SEARCH_TIME_LIMIT"] = 1e-9
+    try:
+        response = elogy_client.get(url + "&stream=json")
+        assert response.status_code == 200
+        result = decode_response(response)
+        assert result["error"] == "timeout"
+
+        response = elogy_client.get(url + "&stream=ndjson")
+        lines = response.get_data().decode("utf-8").splitlines()
+        assert json.loads(lines[-1]) == {"error": "timeout"}
+    finally:
+        del app.config["SEARCH_TIME_LIMIT"]
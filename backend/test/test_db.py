@@ -1,8 +1,13 @@
 from operator import attrgetter
 
+from pytest import raises
+
 from .fixtures import db
 from elogy.db import Entry
-from elogy.db import Logbook, LogbookRevision
+from elogy.db import Logbook, LogbookRevision, LogbookClosure
+from elogy.db import SNIPPET_MATCH_START, SearchTimeout, time_limit
+from elogy.db import trigram_query, EntrySnapshot, EntryChange, Attachment
+from elogy.db import EntryTrigram, SearchWord, word_query
 
 
 # Logbook
@@ -33,6 +38,49 @@ def test_logbook_ancestors(db):
     assert set(desc_ids) == set([parent1, child1])
 
 
+def test_logbook_move(db):
+    parent1 = Logbook.create(name="Logbook1")
+    parent2 = Logbook.create(name="Logbook2")
+    child1 = Logbook.create(name="Logbook3", parent=parent1)
+    child1child1 = Logbook.create(name="Logbook4", parent=child1)
+
+    child1.parent = parent2
+    child1.save()
+    assert list(child1child1.ancestors) == [child1, parent2]
+    assert list(parent2.descendants) == [child1, child1child1]
+    assert list(parent1.descendants) == []
+    assert LogbookClosure.check() == ([], [])
+
+
+def test_logbook_edit_not_moved(db, monkeypatch):
+    parent1 = Logbook.create(name="Logbook1")
+    parent2 = Logbook.create(name="Logbook2")
+    child = Logbook.create(name="Logbook3", parent=parent1)
+    moved = []
+    monkeypatch.setattr(LogbookClosure, "move_logbook", moved.append)
+
+    # the parent is always given when editing, even if it's the same
+    child.make_change(name="New name", parent_id=parent1.id).save()
+    child.save()
+    assert moved == []
+
+    child.make_change(name="New name", parent_id=parent2.id).save()
+    child.save()
+    assert moved == [child]
+
+
+def test_logbook_closure_rebuild(db):
+    parent1 = Logbook.create(name="Logbook1")
+    child1 = Logbook.create(name="Logbook2", parent=parent1)
+    LogbookClosure.delete().where(LogbookClosure.depth > 0).execute()
+    missing, extra = LogbookClosure.check()
+    assert missing == [(parent1.id, child1.id, 1)]
+    assert extra == []
+    LogbookClosure.rebuild()
+    assert LogbookClosure.check() == ([], [])
+    assert list(parent1.descendants) == [child1]
+
+
 def test_logbook_entries(db):
     lb = Logbook.create(name="Logbook1", description="Hello")
     entry2 = Entry.create(logbook=lb, title="Entry1")
@@ -127,6 +175,20 @@ def test_entry(db):
     assert entry.title == "Entry1"
 
 
+def test_entry_text(db):
+    lb = Logbook.create(name="Logbook1")
+    entry = Entry.create(logbook=lb, title="Entry",
+                         content="<p>Some <b>bold</b>\ntext &amp; more</p>")
+    assert entry.text == "Some bold\ntext & more"
+    assert entry.preview == "Some bold text & more"
+
+    # entries from before the text was stored
+    Entry.update(text=None, preview=None).execute()
+    assert Entry.backfill_text() == 1
+    entry = Entry.get(Entry.id == entry.id)
+    assert entry.preview == "Some bold text & more"
+
+
 def test_enryrevision(db):
     lb = Logbook.create(name="Logbook1", description="Hello")
     entry = Entry.create(logbook=lb, title="Entry1")
@@ -198,6 +260,95 @@ def test_entryrevisionwrapper2(db):
 
 # Search
 
+def test_entryrevision_snapshots(db):
+    lb = Logbook.create(name="Logbook1")
+    entry = Entry.create(logbook=lb, title="Title 0", content="Content 0")
+    n = 2 * EntrySnapshot.INTERVAL + 3
+    for i in range(1, n + 1):
+        # change the content every time, but the title only sometimes
+        data = {"content": "Content {}".format(i)}
+        if i % 3 == 0:
+            data["title"] = "Title {}".format(i)
+        change = entry.make_change(**data)
+        entry.save()
+        change.save()
+
+    assert EntrySnapshot.select().where(EntrySnapshot.entry == entry).count() == 2
+    for i in range(n):
+        revision = entry.get_revision(version=i)
+        assert revision.revision_n == i
+        assert revision.content == "Content {}".format(i)
+        assert revision.title == "Title {}".format(i - i % 3)
+
+
+def test_entry_content_history(db):
+    lb = Logbook.create(name="Logbook1")
+    lines = ["Line {}\n".format(i) for i in range(20)]
+    contents = ["".join(lines)]
+    entry = Entry.create(logbook=lb, title="Entry", content=contents[0])
+    for i in range(25):
+        lines[i % 20] = "Changed line {}\n".format(i)
+        contents.append("".join(lines))
+        change = entry.make_change(content=contents[-1])
+        entry.save()
+        change.save()
+
+    changes = list(entry.changes)
+    # most changes are stored as patches, with regular keyframes
+    assert ["content" in change.changed for change in changes] == [
+        i % EntryChange.KEYFRAME_INTERVAL == EntryChange.KEYFRAME_INTERVAL - 1
+        for i in range(25)]
+    for i, change in enumerate(changes):
+        assert change.get_old_value("content") == contents[i]
+        assert change.get_new_value("content") == contents[i + 1]
+        assert entry.get_revision(i).content == contents[i]
+
+    # old style history, with the whole content in each change
+    for i, change in enumerate(changes):
+        change.changed = {"content": contents[i]}
+        change.save()
+    EntryChange.compact_entry(entry)
+    changes = list(entry.changes)
+    assert "content_patch" in changes[0].changed
+    for i, change in enumerate(changes):
+        assert change.get_old_value("content") == contents[i]
+
+
+def test_entry_get_changes(db):
+    lb = Logbook.create(name="Logbook1")
+    entry = Entry.create(logbook=lb, title="Entry", content="Hello",
+                         authors=[{"name": "A"}])
+    for i in range(12):
+        change = entry.make_change(title="Entry {}".format(i % 3),
+                                   content="Hello {}".format(i),
+                                   authors=[{"name": "A"}] * (i % 2 + 1))
+        entry.save()
+        change.save()
+
+    # the values computed in one pass must agree with the slow path
+    changes = entry.get_changes()
+    assert [c.id for c in changes] == [c.id for c in entry.changes]
+    for change, slow in zip(changes, entry.changes):
+        for attr in ["title", "content", "authors"]:
+            assert change.get_old_value(attr) == slow.get_old_value(attr)
+            assert change.get_new_value(attr) == slow.get_new_value(attr)
+
+
+def test_logbook_get_changes(db):
+    lb = Logbook.create(name="Logbook1", description="Hello")
+    for i in range(5):
+        change = lb.make_change(name="Logbook {}".format(i % 2),
+                                description="Hello {}".format(i))
+        lb.save()
+        change.save()
+
+    changes = lb.get_changes()
+    for change, slow in zip(changes, lb.changes):
+        for attr in ["name", "description"]:
+            assert change.get_old_value(attr) == slow.get_old_value(attr)
+            assert change.get_new_value(attr) == slow.get_new_value(attr)
+
+
 def test_entry_content_search(db):
     lb1 = Logbook.create(name="Logbook1")
     lb2 = Logbook.create(name="Logbook2")
@@ -239,6 +390,50 @@ def test_entry_content_search(db):
     assert result.title == "Third entry"
 
 
+def test_entry_content_search_edited(db):
+
+    """The full-text index must follow edits, and only look at the
+    text of HTML content, not the markup."""
+
+    lb = Logbook.create(name="Logbook1")
+    entry = Entry.create(logbook=lb, title="First entry",
+                         content="<p class='great'>Original content</p>")
+
+    assert list(Entry.search(logbook=lb, content_filter="great")) == []
+    result, = list(Entry.search(logbook=lb, content_filter="orig"))
+    assert result.id == entry.id
+
+    change = entry.make_change(content="<p>Edited content</p>")
+    entry.save()
+    change.save()
+
+    assert list(Entry.search(logbook=lb, content_filter="original")) == []
+    result, = list(Entry.search(logbook=lb, content_filter="edited content"))
+    assert result.id == entry.id
+
+
+def test_entry_content_search_ranked(db):
+    lb = Logbook.create(name="Logbook1")
+    Entry.create(logbook=lb, title="First entry",
+                 content="The beam was lost, then the beam came back.")
+    Entry.create(logbook=lb, title="Second entry",
+                 content="Shift summary: quiet night, the beam was stable "
+                         "the whole time and nothing else happened at all.")
+    Entry.create(logbook=lb, title="Third entry",
+                 content="Nothing to see here.")
+
+    results = list(Entry.search(logbook=lb, content_filter="beam",
+                                ranked=True))
+    assert [r.title for r in results] == ["First entry", "Second entry"]
+    # the snippet marks the matching words
+    assert results[0].snippet.count(SNIPPET_MATCH_START + "beam") == 2
+
+    # no ranking without full-text search
+    results = list(Entry.search(logbook=lb, ranked=True))
+    assert len(results) == 3
+    assert not hasattr(results[0], "snippet")
+
+
 def test_entry_content_search_global(db):
     lb = Logbook.create(name="Logbook1")
 
@@ -274,6 +469,139 @@ def test_entry_content_search_global(db):
     assert result.title == "Third entry"
 
 
+def test_entry_content_search_regexp(db):
+    lb = Logbook.create(name="Logbook1")
+    Entry.create(logbook=lb, title="First entry",
+                 content="Temperature is 23.5 degrees")
+    Entry.create(logbook=lb, title="Second entry",
+                 content="Pressure is 1.2 bar")
+
+    result, = Entry.search(logbook=lb, content_filter=r"\d+\.\d degrees")
+    assert result.title == "First entry"
+    result, = Entry.search(logbook=lb, content_filter="PRESSURE|bar$")
+    assert result.title == "Second entry"
+
+
+def test_entry_content_search_substring(db):
+    lb = Logbook.create(name="Logbook1")
+    Entry.create(logbook=lb, title="First entry",
+                 content="<p>Alarm from <b>SR-PV-1234</b> again</p>")
+    Entry.create(logbook=lb, title="Second entry",
+                 content="<p>Alarm from SR-PV-1299</p>")
+
+    # fragments inside words
+    result, = Entry.search(logbook=lb, content_filter="pv-123")
+    assert result.title == "First entry"
+    results = list(Entry.search(logbook=lb, content_filter=r"PV-12\d\d"))
+    assert len(results) == 2
+    result, = Entry.search(logbook=lb, content_filter=r"PV-12(34|88)")
+    assert result.title == "First entry"
+
+
+def test_entry_content_search_substring_no_trigrams(db):
+    # older sqlite versions have no trigram index, which should only
+    # make searching slower, and not change the results
+    enabled = EntryTrigram.enabled
+    EntryTrigram.enabled = False
+    try:
+        lb = Logbook.create(name="Logbook1")
+        Entry.create(logbook=lb, title="First entry",
+                     content="<p>Alarm from <b>SR-PV-1234</b> again</p>")
+        Entry.create(logbook=lb, title="Second entry",
+                     content="<p>Nothing more to say</p>")
+
+        result, = Entry.search(logbook=lb, content_filter="pv-123")
+        assert result.title == "First entry"
+        result, = Entry.search(logbook=lb, content_filter="ore")
+        assert result.title == "Second entry"
+        result, = Entry.search(logbook=lb, title_filter="irs")
+        assert result.title == "First entry"
+
+        # when ranking, words are found by the full-text index, and
+        # any regexp is only checked on those
+        result, = Entry.search(logbook=lb, content_filter="alarm",
+                               title_filter=r"^F\w+ entry", ranked=True)
+        assert result.title == "First entry"
+        assert not list(Entry.search(logbook=lb, content_filter="alarm",
+                                     title_filter="^Second", ranked=True))
+    finally:
+        EntryTrigram.enabled = enabled
+
+
+def test_trigram_query():
+    assert trigram_query("content", r"abc\d+def") == 'content: ("abc" AND "def")'
+    assert trigram_query("content", "abc|def") == 'content: (("abc" OR "def"))'
+    # no required part long enough
+    assert trigram_query("content", "ab|cdef") is None
+    assert trigram_query("content", "abc*") is None
+
+
+def test_word_query(db):
+    lb = Logbook.create(name="Logbook1")
+    Entry.create(logbook=lb, title="Beam", content="Subbeam dump at SR-PV-1234")
+
+    # whole words, and starts of words, are found directly
+    assert (word_query("content", "beam dump at")
+            == 'content: (("beam" OR "subbeam") AND "dump" AND "at"*)')
+    # other parts of words are looked up
+    assert word_query("content", "pv-123") == 'content: ("123"*)'
+    assert word_query("content", r"ump\d*") == 'content: (("dump"))'
+    assert word_query("content", "xyzzy") == 'content: (("xyzzy"))'
+    # nothing useful
+    assert word_query("content", r"\d+") is None
+    assert word_query("content", "ab") is None
+
+    # parts of too many different words are not useful either
+    SearchWord.index_entries([Entry(title="word{}".format(i), content="")
+                              for i in range(SearchWord.MAX_MATCHES + 1)])
+    assert word_query("content", "ord") is None
+
+
+def test_time_limit(db):
+    # a query that would take a very long time to finish
+    query = ("WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL"
+             " SELECT i + 1 FROM n) SELECT count(*) FROM n")
+    with raises(SearchTimeout):
+        with time_limit(0.1):
+            db.execute_sql(query).fetchall()
+    # the limit does not stick around afterwards
+    assert db.execute_sql("SELECT 1").fetchall() == [(1,)]
+
+
+def test_bad_regexp(db):
+    from elogy.db import BadRegexp, check_regexp
+    for pattern in [r"abc\d+", "(foo|bar)+", "a.*b", "a{2,3}b",
+                    r"\d+\s*mA", "a.*b.*c"]:
+        check_regexp(pattern)
+    for pattern in ["(a+)+$", "(a*b?)*c", "((ab)+x)*", "a" * 300, "(abc",
+                    "(a|a)*c", r"\w*\w*\w*!", r"\w+\d+", "a*b*c*d*"]:
+        with raises(BadRegexp):
+            check_regexp(pattern)
+
+    lb = Logbook.create(name="Logbook1")
+    Entry.create(logbook=lb, content="a" * 40)
+    # this would take practically forever to fail
+    with raises(BadRegexp):
+        list(Entry.search(logbook=lb, content_filter="(a+)+$b"))
+
+
+def test_regexp_long_text(db):
+    lb = Logbook.create(name="Logbook1")
+    entry = Entry.create(logbook=lb, title="Long entry",
+                         content="x" * 50000 + " SR-PV-1234 " + "a" * 50000)
+    # long texts are searched in pieces, but matches are still found
+    result, = Entry.search(logbook=lb, content_filter=r"pv-\d+")
+    assert result.id == entry.id
+    assert not list(Entry.search(logbook=lb, content_filter=r"pv-1234$"))
+    result, = Entry.search(logbook=lb, content_filter=r"a{10}$")
+    assert result.id == entry.id
+
+    # a slow search is stopped in between the pieces
+    with raises(SearchTimeout):
+        with time_limit(0.1):
+            list(Entry.search(logbook=lb, content_filter=r"a.*a.*a.*!"))
+
+
 def test_entry_title_search(db):
     lb = Logbook.create(name="Logbook1")
 
@@ -342,6 +670,35 @@ def test_entry_search_followups(db):
     assert result.title == "First entry"
 
 
+def test_entry_search_thread_summary(db):
+    lb = Logbook.create(name="Logbook1")
+    entry1 = Entry.create(logbook=lb, title="First entry",
+                          authors=[{"name": "Alice"}])
+    entry2 = Entry.create(logbook=lb, title="Second entry",
+                          authors=[{"name": "Bob"}])
+    followup = Entry.create(logbook=lb, follows=entry1, title="Followup",
+                            authors=[{"name": "Carol"}])
+
+    result1, = [e for e in Entry.search(logbook=lb) if e.id == entry1.id]
+    assert result1.n_followups == 1
+    assert "Carol" in result1.followup_authors
+
+    # moving the followup to another thread should update both
+    followup.follows = entry2
+    followup.save()
+    results = {e.id: e for e in Entry.search(logbook=lb)}
+    assert results[entry1.id].n_followups == 0
+    assert results[entry2.id].n_followups == 1
+    assert "Carol" in results[entry2.id].followup_authors
+
+    # editing it in place only needs to update its own thread
+    followup.authors = [{"name": "Dave"}]
+    followup.save()
+    results = {e.id: e for e in Entry.search(logbook=lb)}
+    assert "Dave" in results[entry2.id].followup_authors
+    assert "Carol" not in results[entry2.id].followup_authors
+
+
 def test_entry_attribute_search_followups(db):
     lb = Logbook.create(name="Logbook1")
 
@@ -560,6 +917,36 @@ def test_entry_metadata_filter(db):
                                                       "Second entry"])
 
 
+def test_entry_metadata_prefix_filter(db):
+
+    lb = Logbook.create(name="Logbook1")
+    Entry.create(logbook=lb, title="First entry",
+                 metadata={"url": "Logbook/12"}, attributes={"n": 3.0})
+    Entry.create(logbook=lb, title="Second entry",
+                 metadata={"url": "Logbook/123"}, attributes={"n": 4.5})
+
+    # exact match, ignoring case
+    result, = list(Entry.search(logbook=lb,
+                                metadata_filter=[("url", "logbook/12")]))
+    assert result.title == "First entry"
+
+    # prefix match
+    results = list(Entry.search(logbook=lb,
+                                metadata_filter=[("url", "Logbook/1*")]))
+    assert len(results) == 2
+
+    # numbers
+    result, = list(Entry.search(logbook=lb, attribute_filter=[("n", "3")]))
+    assert result.title == "First entry"
+
+    # editing the entry updates the index
+    result.metadata = {"url": "Other/1"}
+    result.save()
+    results = list(Entry.search(logbook=lb,
+                                metadata_filter=[("url", "Logbook/1*")]))
+    assert len(results) == 1
+
+
 def test_entry_content_search_child_logbooks(db):
 
     """Searching a logbook with 'child_logbooks' should also return
@@ -620,3 +1007,184 @@ def test_entry_content_search_child_logbooks(db):
 
     assert len(results) == 1
     set([results[0].title]) == "entry2"
+
+
+def test_entry_revision_conflict(db):
+    lb = Logbook.create(name="Logbook1")
+    entry = Entry.create(logbook=lb, title="Entry", content="Hello")
+    assert entry.revision_n == 0
+
+    # two "users" load the entry, and both try to change it
+    entry1 = Entry.get(Entry.id == entry.id)
+    entry2 = Entry.get(Entry.id == entry.id)
+    change = entry1.make_change(title="First")
+    entry1.save()
+    change.save()
+    assert Entry.get(Entry.id == entry.id).revision_n == 1
+
+    entry2.make_change(title="Second")
+    with raises(Entry.Conflict):
+        entry2.save()
+    entry = Entry.get(Entry.id == entry.id)
+    assert entry.title == "First"
+    assert entry.revision_n == entry.changes.count() == 1
+
+
+def test_logbook_revision_conflict(db):
+    lb = Logbook.create(name="Logbook1")
+    lb1 = Logbook.get(Logbook.id == lb.id)
+    lb2 = Logbook.get(Logbook.id == lb.id)
+    lb1.make_change(name="First").save()
+    lb1.save()
+    lb2.make_change(name="Second").save()
+    with raises(Logbook.Conflict):
+        lb2.save()
+    lb = Logbook.get(Logbook.id == lb.id)
+    assert (lb.name, lb.revision_n) == ("First", 1)
+
+
+def test_entry_get_thread(db):
+    lb = Logbook.create(name="Logbook1")
+    entry = Entry.create(logbook=lb, title="Entry")
+    followup1 = Entry.create(logbook=lb, follows=entry)
+    followup2 = Entry.create(logbook=lb, follows=entry)
+    followup11 = Entry.create(logbook=lb, follows=followup1)
+    Attachment.create(entry=followup11, path="a.png")
+    followup11.get_lock(ip="1.2.3.4", acquire=True)
+
+    thread = Entry.get_thread(followup11.id)
+    assert thread.id == entry.id
+    assert [f.id for f in thread.followups] == [followup1.id, followup2.id]
+    loaded11, = thread.followups[0].followups
+    assert loaded11.id == followup11.id
+    assert [a.path for a in loaded11.attachments] == ["a.png"]
+    assert loaded11.lock.owned_by_ip == "1.2.3.4"
+    assert thread.lock is None
+
+    # just the part of the thread below the entry
+    subthread = Entry.get_thread(followup1.id, whole=False)
+    assert subthread.id == followup1.id
+    assert [f.id for f in subthread.followups] == [followup11.id]
+
+
+def test_database_changed(tmpdir):
+    import sqlite3
+    from threading import Thread
+    from elogy.db import db, setup_database, database_changed
+    filename = str(tmpdir.join("test.db"))
+    setup_database(filename, close=False)
+
+    # nothing to compare with yet
+    assert not database_changed()
+    assert not database_changed()
+
+    # a change through the app's connection
+    Logbook.create(name="Logbook1")
+    assert database_changed()
+    assert not database_changed()
+
+    # reading from other threads, using other connections, is not
+    # a change (e.g. with gevent, each request has its own)
+    results = []
+    for _ in range(2):
+        thread = Thread(target=lambda: results.append(
+            (Logbook.select().count(), database_changed())))
+        thread.start()
+        thread.join()
+    assert results == [(1, False), (1, False)]
+
+    # a change through another connection, e.g. another process
+    other = sqlite3.connect(filename)
+    with other:
+        other.execute("UPDATE logbook SET name = 'Logbook2'")
+    other.close()
+    assert database_changed()
+    assert not database_changed()
+    db.close()
+
+
+def test_change_sequence(db):
+    from elogy.db import ChangeSequence
+    parent = Logbook.create(name="Logbook1")
+    child = Logbook.create(name="Logbook2", parent=parent)
+    other = Logbook.create(name="Logbook3")
+    entry1 = Entry.create(logbook=child, title="Entry1")
+    entry2 = Entry.create(logbook=other, title="Entry2")
+    assert (parent.change_seq < child.change_seq < other.change_seq
+            < entry1.change_seq < entry2.change_seq)
+
+    cursor = entry1.change_seq
+    change = entry1.make_change(title="New title")
+    change.save()
+    entry1.save()
+    logbooks, entries, new_cursor = ChangeSequence.get_changed(cursor)
+    assert logbooks == []
+    assert [e.id for e in entries] == [entry2.id, entry1.id]
+    assert entries[1].revision_n == 1
+    assert new_cursor == entry1.change_seq == ChangeSequence.current()
+
+    # only the logbook and its descendants
+    logbooks, entries, _ = ChangeSequence.get_changed(cursor, logbook=parent)
+    assert [e.id for e in entries] == [entry1.id]
+    logbooks, entries, _ = ChangeSequence.get_changed(0, logbook=parent)
+    assert logbooks == [parent, child]
+
+    # in pages
+    seen = []
+    cursor = 0
+    while True:
+        logbooks, entries, cursor = ChangeSequence.get_changed(cursor, limit=2)
+        if not (logbooks or entries):
+            break
+        assert len(logbooks + entries) <= 2
+        seen.extend(logbooks + entries)
+    assert seen == [parent, child, other, entry2, entry1]
+
+    # numbering existing rows, e.g. after the column was added
+    ChangeSequence.setup(renumber=True)
+    logbooks, entries, cursor = ChangeSequence.get_changed(0)
+    assert len(set(row.change_seq for row in logbooks + entries)) == 5
+    assert cursor == max(row.change_seq for row in logbooks + entries)
+    assert ChangeSequence.wait(cursor, 0.01) == cursor
+
+
+def test_change_sequence_attachments(db):
+    from elogy.db import ChangeSequence
+    lb = Logbook.create(name="Logbook1")
+    entry = Entry.create(logbook=lb, title="Entry1")
+    cursor = ChangeSequence.current()
+
+    # the entry must be fetched again, but it's not a new revision
+    attachment = Attachment.create(entry=entry, path="some/file.png")
+    _, entries, cursor = ChangeSequence.get_changed(cursor)
+    assert [e.id for e in entries] == [entry.id]
+    assert entries[0].revision_n == 0
+
+    attachment.delete_instance()
+    _, entries, _ = ChangeSequence.get_changed(cursor)
+    assert [e.id for e in entries] == [entry.id]
+
+
+def test_queued_action_claim(db):
+    from elogy.db import QueuedAction
+    action1 = QueuedAction.create(signal="new_entry", data={"args": [1]})
+    action2 = QueuedAction.create(signal="edit_entry", data={"args": [2]})
+
+    claimed = QueuedAction.claim()
+    assert claimed.id == action1.id
+    assert claimed.attempts == 1
+    assert claimed.data == {"args": [1]}
+    # can't be claimed twice, and busy signals are skipped
+    assert QueuedAction.claim(busy=["edit_entry"]) is None
+    # unless it's been running for too long
+    assert QueuedAction.claim(busy=["edit_entry"], timeout=-1).id == action1.id
+
+    claimed = QueuedAction.claim()
+    assert claimed.id == action2.id
+    claimed.retry("Oops", delay=60)
+    assert QueuedAction.claim() is None
+
+    stats = QueuedAction.get_queue_stats()
+    assert stats["new_entry"]["running"] == 1
+    assert stats["edit_entry"]["waiting"] == 1
+    assert stats["edit_entry"]["oldest"] == action2.created_at
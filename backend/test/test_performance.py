@@ -2,11 +2,18 @@
 Some tests that exercise the server.
 """
 
+from contextlib import contextmanager
+from io import BytesIO
+import json
+import logging
 from random import random, randint, choice
 from string import ascii_letters
+from time import time
 
 from faker import Faker
 
+from elogy.db import EntryTrigram
+
 from .fixtures import elogy_client as client
 from .providers import ElogyProvider
 from .test_api import make_logbook, post_json, decode_response
@@ -16,6 +23,30 @@ fake = Faker()
 fake.add_provider(ElogyProvider)
 
 
+class QueryCounter(logging.Handler):
+    "Counts the SQL queries executed, as logged by peewee"
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+@contextmanager
+def count_queries():
+    logger = logging.getLogger("peewee")
+    counter = QueryCounter()
+    level = logger.level
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(counter)
+    try:
+        yield counter
+    finally:
+        logger.removeHandler(counter)
+        logger.setLevel(level)
+
+
 def test_create_entries(client):
 
     _, lb = make_logbook(client)
@@ -65,13 +96,175 @@ def test_search_content(client):
         if hit:
             hits.add(response["entry"]["id"])
 
-    # do a search for the term
-    search = decode_response(client.get("/api/logbooks/{logbook[id]}/entries/?content={term}&n=1000"
-                                        .format(logbook=lb, term=term)))
+    # do a search for the term, also without the trigram index (as
+    # with older sqlite versions)
+    trigrams = EntryTrigram.enabled
+    try:
+        for enabled in sorted({trigrams, False}):
+            EntryTrigram.enabled = enabled
+            search = decode_response(client.get("/api/logbooks/{logbook[id]}/entries/?content={term}&n=1000"
+                                                .format(logbook=lb, term=term)))
+
+            # check that we found the correct entries
+            assert len(search["entries"]) == len(hits)
+            assert set(entry["id"] for entry in search["entries"]) == hits
+    finally:
+        EntryTrigram.enabled = trigrams
+
+
+def test_change_history_queries(client):
+
+    "Getting the history should not need more queries for more changes"
+
+    _, lb = make_logbook(client)
+    response = decode_response(post_json(
+        client, "/api/logbooks/{logbook[id]}/entries/".format(logbook=lb),
+        data=fake.entry()))
+    entry = response["entry"]
+    url = "/api/logbooks/{logbook[id]}/entries/{entry[id]}/".format(
+        logbook=lb, entry=entry)
+
+    counts = []
+    for n in [5, 50]:
+        while entry["revision_n"] < n:
+            data = fake.entry()
+            data["revision_n"] = entry["revision_n"]
+            entry = decode_response(client.put(
+                url, data=json.dumps(data),
+                content_type="application/json"))["entry"]
+            lb = decode_response(client.put(
+                "/api/logbooks/{logbook[id]}/".format(logbook=lb),
+                data=dict(name=fake.sentence(),
+                          description=fake.sentence())))["logbook"]
+        with count_queries() as entry_queries:
+            changes = decode_response(client.get(url + "revisions/"))
+        assert len(changes["entry_changes"]) == n
+        with count_queries() as logbook_queries:
+            changes = decode_response(client.get(
+                "/api/logbooks/{logbook[id]}/revisions/".format(logbook=lb)))
+        assert len(changes["logbook_changes"]) == n
+        counts.append((entry_queries.count, logbook_queries.count))
+
+    assert counts[0] == counts[1]
+
+
+def test_thread_queries(client):
+
+    "Loading a thread should not need more queries for more followups"
+
+    _, lb = make_logbook(client)
+    url = "/api/logbooks/{logbook[id]}/entries/".format(logbook=lb)
+    entry = decode_response(post_json(client, url, data=fake.entry()))["entry"]
+
+    counts = []
+    followups = [entry]
+    for n in [5, 40]:
+        while len(followups) <= n:
+            # reply to some random earlier entry in the thread
+            parent = choice(followups)
+            followup = decode_response(post_json(
+                client, url + "{}/".format(parent["id"]),
+                data=fake.entry()))["entry"]
+            followups.append(followup)
+        with count_queries() as queries:
+            thread = decode_response(client.get(
+                url + "{}/?thread=true".format(followups[-1]["id"])))
+        assert thread["entry"]["id"] == entry["id"]
+        counts.append(queries.count)
+
+    assert counts[0] == counts[1]
+
+
+def test_compiled_marshal(client):
+
+    "The compiled serializers should give the same result"
+
+    from flask_restful import marshal
+    from elogy.app import app
+    from elogy.db import Logbook
+    from elogy.api import fields
+    from elogy.api.serialize import marshal as compiled_marshal
+
+    _, lb = make_logbook(client)
+    url = "/api/logbooks/{logbook[id]}/entries/".format(logbook=lb)
+    for i in range(1000):
+        entry = decode_response(post_json(client, url, data=fake.entry()))
+        if random() < 0.2:
+            post_json(client, url + "{}/".format(entry["entry"]["id"]),
+                      data=fake.entry())
+
+    with app.test_request_context():
+        app.preprocess_request()
+        logbook = Logbook.get(Logbook.id == lb["id"])
+        entries = list(logbook.get_entries(n=1000))
+        data = dict(logbook=logbook, entries=entries, next_cursor=None)
+
+        start = time()
+        expected = json.dumps(marshal(data, fields.entries))
+        marshal_time = time() - start
+
+        start = time()
+        result = json.dumps(compiled_marshal(data, fields.entries))
+        compiled_time = time() - start
+
+        entry = entries[0]
+        assert (json.dumps(marshal(entry, fields.entry_full)) ==
+                json.dumps(compiled_marshal(entry, fields.entry_full)))
+
+    assert len(entries) == 1000
+    assert result == expected
+    # timing is too noisy to assert on, just report it
+    logging.info("marshal: %.3f s, compiled: %.3f s",
+                 marshal_time, compiled_time)
+
+
+def test_entries_queries(client):
+
+    "Listing entries should not need more queries for more entries"
+
+    _, lb = make_logbook(client)
+    _, child = make_logbook(client, dict(name="Child", parent_id=lb["id"]))
+    counts = []
+    for n in [5, 50]:
+        while True:
+            url = "/api/logbooks/{logbook[id]}/entries/".format(
+                logbook=choice([lb, child]))
+            entry = decode_response(post_json(client, url,
+                                              data=fake.entry()))["entry"]
+            if entry["id"] % n == 0:
+                # make sure there are some attachments
+                client.post(
+                    "/api/logbooks/{logbook[id]}/entries/{entry[id]}/attachments/"
+                    .format(logbook=entry["logbook"], entry=entry),
+                    data={"attachment": (BytesIO(b"hello"), "hello.txt")})
+            listing = decode_response(client.get(
+                "/api/logbooks/{logbook[id]}/entries/?n=1000".format(logbook=lb)))
+            if len(listing["entries"]) == n:
+                break
+        with count_queries() as queries:
+            # (not the same URL as above, since that is cached)
+            listing = decode_response(client.get(
+                "/api/logbooks/{logbook[id]}/entries/?n=999".format(logbook=lb)))
+        assert any(e["attachment_preview"] for e in listing["entries"])
+        counts.append(queries.count)
+
+    assert counts[0] == counts[1]
+
+
+def test_logbook_tree_queries(client):
+
+    "The logbook tree should be loaded with one query, and then cached"
+
+    parents = [None]
+    for i in range(50):
+        _, lb = make_logbook(client, dict(name=fake.sentence(),
+                                          parent_id=choice(parents)))
+        parents.append(lb["id"])
 
-    # check that we found the correct entries
-    assert len(search["entries"]) == len(hits)
-    for entry in search["entries"]:
-        assert entry["id"] in hits
-        hits.remove(entry["id"])
-    assert not hits
+    with count_queries() as queries:
+        tree = decode_response(client.get("/api/logbooks/"))
+    assert queries.count == 1
+    with count_queries() as queries:
+        assert decode_response(client.get("/api/logbooks/")) == tree
+        decode_response(client.get("/api/logbooks/{}/".format(parents[-1])))
+    assert queries.count == 0
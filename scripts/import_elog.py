@@ -37,6 +37,12 @@ script at regular intervals. This is probably not a great idea unless
 needed for a limited transfer period, as it likely does not cover all
 possible corner cases.
 
+The "--state" parameter names a file where the script keeps track of
+which elogy entries the elog entries were imported to (and their
+revisions and modification times), and of how far it has looked at
+changes in elogy. This way, the next run only needs to ask about
+entries that have changed since.
+
 After running this script, you may also want to run "fix_elog_links.py" in
 order to repair any links in entries to attachments or other entries. See
 that script for more details
@@ -405,6 +411,40 @@ def create_attachment(session, url, filename, embedded=False):
         logging.error("Could not find attachment '%s'", filename)
 
 
+def get_changed_entries(session, url, since=0):
+    """helper to get the revision and timestamps of the entries
+    changed after the given cursor, keyed on id. Also returns the
+    cursor to start from next time."""
+    entries = {}
+    while True:
+        changed = session.get(url, params={"since": since}).json()["changed"]
+        since = changed["cursor"]
+        if not (changed["entries"] or changed["logbooks"]):
+            return entries, since
+        for entry in changed["entries"]:
+            entries[entry["id"]] = entry
+
+
+def load_state(filename):
+    "helper to read what we know from the last run, if anything"
+    state = {"cursor": 0, "entries": {}}
+    if filename and os.path.exists(filename):
+        with open(filename) as f:
+            state.update(json.load(f))
+    return state
+
+
+def save_state(filename, state):
+    with open(filename, "w") as f:
+        json.dump(state, f)
+
+
+def entry_state(entry):
+    "helper to pick what we need to remember about an imported entry"
+    return {key: entry.get(key)
+            for key in ["id", "revision_n", "created_at", "last_changed_at"]}
+
+
 if __name__ == "__main__":
 
     import argparse
@@ -424,6 +464,8 @@ if __name__ == "__main__":
                         help="Only consider entries added/modified after this time")
     parser.add_argument("-i", "--ignore", action="store_false",
                         dest="check",  help="Don't care if logbooks and entries already exist")
+    parser.add_argument("--state", type=str,
+                        help="File to keep track of what has been imported, which makes the next run quicker")
     parser.add_argument("-v", "--verbose", action="store_true", default=False,
                         help="Print out debug information about what's going on")
 
@@ -443,6 +485,7 @@ if __name__ == "__main__":
     LOGBOOK_URL = "%s/api/logbooks/" % host_port
     ENTRY_URL = "%s/api/logbooks/{logbook_id}/entries/" % host_port
     ATTACHMENT_URL = "%s/api/logbooks/{logbook[id]}/entries/{entry[id]}/attachments/" % host_port
+    CHANGES_URL = "%s/api/logbooks/{logbook_id}/changes/" % host_port
 
     config = configparser.RawConfigParser(strict=False)
     config.optionxform = str  # preserve key case
@@ -553,6 +596,27 @@ if __name__ == "__main__":
 
     logging.info("Number of entries to check: %d", len(entries))
 
+    def get_logbook_result(logbook_uuid):
+        if logbook_uuid in imported_logbooks:
+            return imported_logbooks[logbook_uuid]
+        return existing_logbooks[logbooks[logbook_uuid]["name"]]
+
+    # The entries that have changed in elogy since the last run (or ever,
+    # the first time) in the logbooks we are importing to, so that we
+    # don't have to fetch each of them to see if they need updating.
+    state = load_state(args.state)
+    changed_entries = {}
+    cursor = None
+    for logbook_id in set(get_logbook_result(logbook_uuid)["id"]
+                          for logbook_uuid, mid in entries):
+        changed, logbook_cursor = get_changed_entries(
+            s, CHANGES_URL.format(logbook_id=logbook_id), since=state["cursor"])
+        changed_entries.update(changed)
+        # they should be the same, unless something changed meanwhile,
+        # and then we'd better look at it again next time
+        if cursor is None or logbook_cursor < cursor:
+            cursor = logbook_cursor
+
     # sort entries by creation time. By inserting them in chronological order,
     # hopefully we can be sure that replies will work properly
     sorted_entries = OrderedDict(
@@ -566,23 +630,34 @@ if __name__ == "__main__":
 
         logbook = logbooks[logbook_uuid]
 
-        if logbook_uuid in imported_logbooks:
-            logbook_result = imported_logbooks[logbook_uuid]
-        else:
-            logbook_result = existing_logbooks[logbook["name"]]
+        logbook_result = get_logbook_result(logbook_uuid)
         # First check if the entry has been imported already.
         # for this we make use of the "metadata" inserted
-        # with entries imported with this script.
-        metadata_filter = ("original_elog_url:{}"
-                           .format(entry["metadata"]["original_elog_url"]))
+        # with entries imported with this script, unless we
+        # remember it from the last run.
+        elog_url = entry["metadata"]["original_elog_url"]
         get_url = ENTRY_URL.format(logbook_id=logbook_result["id"])
-        results = s.get(get_url,
-                        params={"metadata": metadata_filter}).json()["entries"]
-        if results:
+        known_entry = state["entries"].get(elog_url)
+        if isinstance(known_entry, int):
+            # older state files only have the id
+            known_entry = {"id": known_entry}
+        if known_entry is None:
+            metadata_filter = "original_elog_url:{}".format(elog_url)
+            results = s.get(get_url,
+                            params={"metadata": metadata_filter}).json()["entries"]
+            if results:
+                known_entry = {"id": results[0]["id"]}
+        if known_entry is not None:
             # This means the entry has already been imported
-            short_entry = results[0]
-            existing_entry = s.get(get_url +
-                                   str(short_entry["id"]) + "/").json()["entry"]
+            entry_id = known_entry["id"]
+            existing_entry = changed_entries.get(entry_id)
+            if existing_entry is None and "revision_n" in known_entry:
+                # not changed in elogy since last time
+                existing_entry = known_entry
+            if existing_entry is None:
+                # we don't know what it looks like; must look
+                existing_entry = s.get(get_url + str(entry_id) + "/").json()["entry"]
+            state["entries"][elog_url] = entry_state(existing_entry)
             if (parse_time(get_modification_time(existing_entry))
                     > get_modification_time(entry)):
                 # entry has not been edited since import, ignore
@@ -595,7 +670,10 @@ if __name__ == "__main__":
             result = update_entry(s, update_url, logbook_result["id"],
                                   entry, imported_entries,
                                   revision_n=existing_entry["revision_n"])
-            if result.status_code != 200:
+            if result.status_code == 200:
+                state["entries"][elog_url] = entry_state(
+                    result.json()["entry"])
+            else:
                 logging.info("failed to update entry {}/{} {}",
                              logbook_result["name"], mid, result.json())
         else:
@@ -619,8 +697,14 @@ if __name__ == "__main__":
                     logging.info("uploaded attachment %s to %s/%d -> %d",
                                  filename, logbook_result["name"], mid, result["id"])
                 imported_entries[(logbook_uuid, mid)] = result
+                state["entries"][elog_url] = entry_state(result)
             else:
                 logging.error("failed to create entry %s/%d %r",
                               logbook_result["name"], mid, result)
 
+    if args.state:
+        if cursor is not None:
+            state["cursor"] = cursor
+        save_state(args.state, state)
+
     # TODO: what about attachments?